@@ -0,0 +1,107 @@
+"""
+Per-file cost of turning a pyrogram media object into a Media document.
+
+    python3 -m benchmarks.codec [files]
+
+"before" is the previous path: full FileId.decode, byte-by-byte file_id RLE and a umongo
+Media document. "after" is utils.database.media_document. Both must produce the same _id/file_ref.
+"""
+import os
+import sys
+import time
+import base64
+import random
+from struct import pack
+from types import SimpleNamespace
+
+for name, value in (('API_ID', '1'), ('API_HASH', 'x'), ('BOT_TOKEN', '1:x'), ('ADMINS', '1'), ('CHANNELS', '1'),
+                    ('DATABASE_URI', 'mongodb://localhost'), ('DATABASE_NAME', 'benchmark')):
+    os.environ.setdefault(name, value)
+
+from bson import ObjectId
+from pyrogram.file_id import FileId, FileType
+
+from utils.database import Media, media_document
+from utils.helpers import encode_file_ref
+from utils.search_index import search_terms
+
+
+def legacy_encode_file_id(s):
+    r = b""
+    n = 0
+    for i in s + bytes([22]) + bytes([4]):
+        if i == 0:
+            n += 1
+        else:
+            if n:
+                r += b"\x00" + bytes([n])
+                n = 0
+            r += bytes([i])
+    return base64.urlsafe_b64encode(r).decode().rstrip("=")
+
+
+def legacy_document(media):
+    decoded = FileId.decode(media.file_id)
+    file_id = legacy_encode_file_id(
+        pack("<iiqq", int(decoded.file_type), decoded.dc_id, decoded.media_id, decoded.access_hash)
+    )
+    tokens, grams = search_terms(media.file_name)
+    return Media(
+        file_id=file_id,
+        file_ref=encode_file_ref(decoded.file_reference),
+        file_name=media.file_name,
+        file_size=media.file_size,
+        file_type=media.file_type,
+        mime_type=media.mime_type,
+        caption=None,
+        search_tokens=tokens,
+        search_grams=grams,
+        created=ObjectId(),
+    ).to_mongo()
+
+
+def sample_media(count, seed=0):
+    rnd = random.Random(seed)
+    files = []
+    for i in range(count):
+        file_id = FileId(
+            file_type=rnd.choice([FileType.DOCUMENT, FileType.VIDEO, FileType.AUDIO]),
+            dc_id=rnd.randint(1, 5),
+            media_id=rnd.getrandbits(63),
+            access_hash=rnd.getrandbits(63),
+            file_reference=bytes(rnd.getrandbits(8) for _ in range(rnd.choice([0, 20, 29]))),
+        ).encode()
+        files.append(SimpleNamespace(
+            file_id=file_id,
+            file_name=f"Some.Movie.{i}.{rnd.randint(1950, 2024)}.1080p.WEB-DL.x264.mkv",
+            file_size=rnd.randint(10 ** 6, 4 * 10 ** 9),
+            file_type="video",
+            mime_type="video/x-matroska",
+            caption=None,
+        ))
+    return files
+
+
+def measure(func, files):
+    started = time.perf_counter()
+    docs = [func(media) for media in files]
+    return docs, (time.perf_counter() - started) / len(files) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    files = sample_media(count)
+
+    before, before_us = measure(legacy_document, files)
+    after, after_us = measure(media_document, files)
+
+    for old, new in zip(before, after):
+        assert (old["_id"], old["file_ref"]) == (new["_id"], new["file_ref"]), (old, new)
+
+    print(f"{count} files")
+    print(f"before: {before_us:8.1f} us/file")
+    print(f"after:  {after_us:8.1f} us/file  ({before_us / after_us:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
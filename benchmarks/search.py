@@ -0,0 +1,197 @@
+"""
+Latency benchmark of get_search_results on a synthetic Media corpus.
+
+    python3 -m benchmarks.search --docs 100000 --queries 500
+    python3 -m benchmarks.search --mongo mongodb://localhost:27017 --index --save run.json
+    python3 -m benchmarks.search --compare run.json
+
+Without --mongo the corpus lives in mongomock (pip install mongomock-motor), which is fine for
+comparing the in-memory index and client side stages but not for server side query costs.
+With --mongo a throwaway database is created on that server and dropped afterwards.
+Corpus and query mix only depend on --seed, so runs with the same arguments are comparable.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+STAGES = ("bloom", "negative", "index", "recent", "indexed", "timeout", "shed", "regex", "fallback", "none")
+WORDS = (
+    "avatar", "avengers", "batman", "begins", "dark", "knight", "rises", "inception", "interstellar", "matrix",
+    "reloaded", "revolutions", "titanic", "gladiator", "joker", "frozen", "coco", "up", "it", "dune", "part",
+    "two", "the", "of", "and", "lord", "rings", "return", "king", "fellowship", "towers", "harry", "potter",
+    "chamber", "secrets", "prisoner", "azkaban", "goblet", "fire", "star", "wars", "empire", "strikes", "back",
+    "breaking", "bad", "money", "heist", "stranger", "things", "office", "friends", "sherlock", "narcos",
+)
+QUALITIES = ("480p", "720p", "1080p", "2160p")
+SOURCES = ("WEB-DL", "WEBRip", "BluRay", "HDTV", "DVDRip")
+CODECS = ("x264", "x265", "HEVC", "AAC")
+GROUPS = ("YTS", "RARBG", "PSA", "GalaxyRG", "Pahe")
+TYPES = (("video", "video/x-matroska", ".mkv"), ("video", "video/mp4", ".mp4"),
+         ("document", "application/zip", ".zip"), ("audio", "audio/mpeg", ".mp3"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=10000, help="corpus size")
+    parser.add_argument("--queries", type=int, default=300, help="queries per category")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mongo", help="MongoDB URI, mongomock is used if omitted")
+    parser.add_argument("--index", action="store_true", help="build the in-memory search index first")
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    return parser.parse_args()
+
+
+def make_title(rnd):
+    return [rnd.choice(WORDS).capitalize() for _ in range(rnd.randint(1, 5))]
+
+
+def make_corpus(count, seed):
+    """Yield (file_name, caption, file_type, mime_type, file_size) of release style file names"""
+    rnd = random.Random(seed)
+    for i in range(count):
+        title = make_title(rnd)
+        file_type, mime_type, ext = rnd.choice(TYPES)
+        if rnd.random() < 0.3:
+            name = f"{'.'.join(title)}.S{rnd.randint(1, 9):02d}E{rnd.randint(1, 24):02d}"
+        else:
+            name = f"{'.'.join(title)}.{rnd.randint(1950, 2024)}"
+        name += f".{rnd.choice(QUALITIES)}.{rnd.choice(SOURCES)}.{rnd.choice(CODECS)}-{rnd.choice(GROUPS)}{ext}"
+        if rnd.random() < 0.2:
+            name = name.replace(".", " ", name.count(".") - 1)
+        caption = f"<b>{' '.join(title)}</b> @channel" if rnd.random() < 0.5 else None
+        yield name, caption, file_type, mime_type, rnd.randint(10 ** 5, 4 * 10 ** 9)
+
+
+def make_queries(count, seed):
+    """Return {category: [(query, file_type, pages)]}"""
+    rnd = random.Random(seed + 1)
+    short = [w for w in WORDS if len(w) <= 3]
+    mix = {"short": [], "long": [], "miss": [], "file_type": [], "deep": []}
+    for _ in range(count):
+        mix["short"].append((rnd.choice(short), None, 1))
+        mix["long"].append((" ".join(w.lower() for w in make_title(rnd)[:4]) + f" {rnd.choice(QUALITIES)}", None, 1))
+        mix["miss"].append(("".join(rnd.choice("qxzjkv") for _ in range(rnd.randint(4, 10))), None, 1))
+        mix["file_type"].append((rnd.choice(WORDS), rnd.choice(("video", "document", "audio")), 1))
+        mix["deep"].append((rnd.choice(WORDS), None, 5))
+    return mix
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def load_corpus(db, count, seed):
+    from bson import ObjectId
+    from utils.search_index import search_terms
+
+    col = db[db_module.COLLECTION_NAME]
+    batch = []
+    for i, (name, caption, file_type, mime_type, size) in enumerate(make_corpus(count, seed)):
+        tokens, grams = search_terms(name, caption if db_module.USE_CAPTION_FILTER else None)
+        batch.append({
+            "_id": f"bench{i}", "file_ref": None, "file_name": name, "file_size": size, "file_type": file_type,
+            "mime_type": mime_type, "caption": caption, "search_tokens": tokens, "search_grams": grams,
+            "created": ObjectId(),
+        })
+        if len(batch) >= 5000:
+            await col.insert_many(batch)
+            batch = []
+    if batch:
+        await col.insert_many(batch)
+
+
+async def run_queries(mix):
+    from utils.metrics import SearchTrace, current_trace
+
+    results = {}
+    for category, queries in mix.items():
+        latencies, scanned, stages = [], [], dict.fromkeys(STAGES, 0)
+        for query, file_type, pages in queries:
+            offset = ""
+            for _ in range(pages):
+                trace = SearchTrace()
+                token = current_trace.set(trace)
+                started = time.perf_counter()
+                _, offset = await db_module.get_search_results(query, file_type=file_type, offset=offset)
+                latencies.append((time.perf_counter() - started) * 1000)
+                current_trace.reset(token)
+                scanned.append(trace.scanned)
+                stages[trace.stage or "none"] += 1
+                if not offset:
+                    break
+        results[category] = {
+            "requests": len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "avg_scanned": sum(scanned) / len(scanned) if scanned else 0,
+            "stages": {stage: n for stage, n in stages.items() if n},
+        }
+    return results
+
+
+def report(results, baseline=None):
+    print(f"{'category':<10} {'requests':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'scanned':>9}  stages")
+    for category, row in results.items():
+        line = (f"{category:<10} {row['requests']:>8} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+                f"{row['p99_ms']:>9.2f} {row['avg_scanned']:>9.0f}  "
+                + ", ".join(f"{stage}={n}" for stage, n in row["stages"].items()))
+        print(line)
+        old = (baseline or {}).get(category)
+        if old:
+            deltas = [f"{key} {(row[key] - old[key]) / old[key] * 100:+.0f}%"
+                      for key in ("p50_ms", "p95_ms", "p99_ms") if old[key]]
+            print(f"{'':<10} vs baseline: " + ", ".join(deltas))
+
+
+async def main(args):
+    if args.mongo:
+        db = db_module.database
+        await db_module.Media.ensure_indexes()
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        db = db_module.database = AsyncMongoMockClient()[os.environ["DATABASE_NAME"]]
+
+    try:
+        started = time.perf_counter()
+        await load_corpus(db, args.docs, args.seed)
+        print(f"Loaded {args.docs} files in {time.perf_counter() - started:.1f}s")
+        if args.index:
+            started = time.perf_counter()
+            await db_module.build_search_index()
+            print(f"Built search index in {time.perf_counter() - started:.1f}s")
+
+        results = await run_queries(make_queries(args.queries, args.seed))
+    finally:
+        if args.mongo:
+            await db.client.drop_database(db.name)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    for name, value in (('API_ID', '1'), ('API_HASH', 'x'), ('BOT_TOKEN', '1:x'), ('ADMINS', '1'), ('CHANNELS', '1')):
+        os.environ.setdefault(name, value)
+    os.environ['DATABASE_URI'] = arguments.mongo or 'mongodb://localhost'
+    os.environ['DATABASE_NAME'] = f'media_search_benchmark_{arguments.seed}'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import utils.database as db_module
+    asyncio.get_event_loop().run_until_complete(main(arguments))
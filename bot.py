@@ -1,14 +1,31 @@
+import time
+import asyncio
 import logging
 import logging.config
 
+started = time.monotonic()
+
 # Get logging configurations
 logging.config.fileConfig('logging.conf')
 logging.getLogger().setLevel(logging.WARNING)
 
 from pyrogram import Client, __version__
 from pyrogram.raw.all import layer
-from utils import Media
-from info import SESSION, API_ID, API_HASH, BOT_TOKEN
+from utils import (
+    build_search_index, build_gram_filter, ensure_indexes, use_search_workers, save_search_snapshot, watch_changes,
+    prewarm_queries,
+)
+from utils.ingest import write_buffer
+from utils.metrics import start_metrics_server
+from utils.workers import SearchWorkers
+from info import (
+    SESSION, API_ID, API_HASH, BOT_TOKEN, METRICS_PORT, SEARCH_WORKERS, USE_CAPTION_FILTER, INDEX_SNAPSHOT,
+    INDEX_SNAPSHOT_INTERVAL, WATCH_CHANGES, PREWARM_QUERIES,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+imported = time.monotonic()
 
 
 class Bot(Client):
@@ -23,18 +40,69 @@ class Bot(Client):
             plugins={"root": "plugins"},
             sleep_threshold=5,
         )
+        self.search_workers = None
 
     async def start(self):
+        phases = {"imports": imported - started}
+        phase = time.monotonic()
         await super().start()
-        await Media.ensure_indexes()
+        phases["telegram"] = time.monotonic() - phase
+
+        # searches are answered from MongoDB until these are done, none of them holds up the start
+        phase = time.monotonic()
+        if SEARCH_WORKERS:
+            self.search_workers = SearchWorkers(SEARCH_WORKERS, USE_CAPTION_FILTER, INDEX_SNAPSHOT)
+            self.search_workers.start()
+            use_search_workers(self.search_workers)
+        asyncio.create_task(self.background("MongoDB indexes", ensure_indexes()))
+        asyncio.create_task(self.background("Gram filter", build_gram_filter()))
+        asyncio.create_task(self.background("Search index", build_search_index()))
+        if WATCH_CHANGES:
+            asyncio.create_task(self.background("Change watcher", watch_changes()))
+        if PREWARM_QUERIES:
+            asyncio.create_task(self.background("Query prewarming", prewarm_queries()))
+        if INDEX_SNAPSHOT:
+            asyncio.create_task(self.save_snapshots())
+        if METRICS_PORT:
+            await start_metrics_server(METRICS_PORT)
+        phases["tasks"] = time.monotonic() - phase
+
+        phase = time.monotonic()
         me = await self.get_me()
         self.username = '@' + me.username
+        phases["get_me"] = time.monotonic() - phase
+        phases["total"] = time.monotonic() - started
+        logger.info("Startup " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases.items()))
         print(f"{me.first_name} with for Pyrogram v{__version__} (Layer {layer}) started on {me.username}.")
 
+    async def background(self, name, task):
+        """Await a startup task without holding up start, logging when it is done"""
+        try:
+            await task
+        except Exception:
+            logger.exception(f'{name} failed')
+        else:
+            logger.info(f'{name} ready {time.monotonic() - started:.1f}s after start')
+
+    async def save_snapshots(self):
+        while True:
+            await asyncio.sleep(INDEX_SNAPSHOT_INTERVAL)
+            try:
+                await save_search_snapshot()
+            except Exception:
+                logger.exception('Failed to save search index snapshot')
+
     async def stop(self, *args):
         await super().stop()
+        await write_buffer.close()
+        if INDEX_SNAPSHOT:
+            await save_search_snapshot()
+        if self.search_workers:
+            self.search_workers.stop()
         print("Bot stopped. Bye.")
 
 
-app = Bot()
-app.run()
+# search worker processes are spawned and import this module again, they must not start the bot
+if __name__ == '__main__':
+    app = Bot()
+    app.run()
@@ -14,6 +14,28 @@ USERBOT_STRING_SESSION = environ.get('USERBOT_STRING_SESSION')
 # Bot settings
 CACHE_TIME = int(environ.get('CACHE_TIME', 300))
 USE_CAPTION_FILTER = bool(environ.get('USE_CAPTION_FILTER', False))
+RANK_CANDIDATES = int(environ.get('RANK_CANDIDATES', 500))
+DUPLICATE_DISTANCE = int(environ.get('DUPLICATE_DISTANCE', 0))
+SPELL_DISTANCE = int(environ.get('SPELL_DISTANCE', 2))
+RESULT_CACHE_SIZE = int(environ.get('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_TTL = int(environ.get('RESULT_CACHE_TTL', 60))
+NEGATIVE_CACHE_SIZE = int(environ.get('NEGATIVE_CACHE_SIZE', 10000))
+NEGATIVE_CACHE_TTL = int(environ.get('NEGATIVE_CACHE_TTL', 600))
+PREWARM_QUERIES = int(environ.get('PREWARM_QUERIES', 200))
+PREWARM_INTERVAL = int(environ.get('PREWARM_INTERVAL', 45))
+INLINE_DEBOUNCE = float(environ.get('INLINE_DEBOUNCE', 0.3))
+INLINE_RATE = float(environ.get('INLINE_RATE', 1))
+INLINE_BURST = float(environ.get('INLINE_BURST', 10))
+EXPENSIVE_SEARCHES = int(environ.get('EXPENSIVE_SEARCHES', 4))
+INDEX_CONCURRENCY = int(environ.get('INDEX_CONCURRENCY', 2))
+WRITE_BUFFER_SIZE = int(environ.get('WRITE_BUFFER_SIZE', 500))
+WRITE_BUFFER_DELAY = float(environ.get('WRITE_BUFFER_DELAY', 1))
+METRICS_PORT = int(environ.get('METRICS_PORT', 0))
+SEARCH_WORKERS = int(environ.get('SEARCH_WORKERS', 0))
+INDEX_SNAPSHOT = environ.get('INDEX_SNAPSHOT', '')
+INDEX_SNAPSHOT_INTERVAL = int(environ.get('INDEX_SNAPSHOT_INTERVAL', 3600))
+WATCH_CHANGES = bool(environ.get('WATCH_CHANGES', False))
+CHANGES_POLL_INTERVAL = int(environ.get('CHANGES_POLL_INTERVAL', 10))
 
 # Admins, Channels & Users
 ADMINS = [int(admin) if id_pattern.search(admin) else admin for admin in environ['ADMINS'].split()]
@@ -27,6 +49,11 @@ AUTH_CHANNEL = int(auth_channel) if auth_channel and id_pattern.search(auth_chan
 DATABASE_URI = environ['DATABASE_URI']
 DATABASE_NAME = environ['DATABASE_NAME']
 COLLECTION_NAME = environ.get('COLLECTION_NAME', 'Telegram_files')
+MONGO_MAX_POOL_SIZE = int(environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_TIMEOUT_MS = int(environ.get('MONGO_TIMEOUT_MS', 5000))
+SEARCH_TIME_LIMIT_MS = int(environ.get('SEARCH_TIME_LIMIT_MS', 2000))
+SEARCH_READ_PREFERENCE = environ.get('SEARCH_READ_PREFERENCE', 'primary')
 
 # Messages
 default_start_msg = """
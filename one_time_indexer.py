@@ -5,10 +5,13 @@ import logging.config
 logging.config.fileConfig('logging.conf')
 logging.getLogger().setLevel(logging.WARNING)
 
+import sys
 import asyncio
 from pyrogram import Client
 from info import SESSION, USERBOT_STRING_SESSION, API_ID, API_HASH, BOT_TOKEN, CHANNELS
-from utils import save_file
+from utils import migrate_media
+from utils.ingest import Ingester, history_ids
+from utils.scheduling import FloodScheduler
 
 
 async def main():
@@ -20,23 +23,26 @@ async def main():
     await user_bot.start()
     await bot.start()
 
+    scheduler = FloodScheduler()
+    ingester = Ingester(bot, scheduler)
     try:
         for channel in CHANNELS:
-            async for user_message in user_bot.get_chat_history(channel):
-                message = await bot.get_messages(channel, user_message.id, replies=0)
-                for file_type in ("document", "video", "audio"):
-                    media = getattr(message, file_type, None)
-                    if media is not None:
-                        break
-                else:
-                    continue
-                media.file_type = file_type
-                media.caption = message.caption
-                await save_file(media)
+            await ingester.run(channel, history_ids(user_bot, channel, scheduler))
+            print(f"{channel}: {ingester.checked} checked, {ingester.saved} files saved so far")
     finally:
         await user_bot.stop()
         await bot.stop()
 
 
+async def migrate():
+    """Backfill search terms of already saved files, run with --migrate"""
+
+    async def progress(done):
+        print(f"{done} files updated")
+
+    total = await migrate_media(batch_size=5000, progress=progress)
+    print(f"Migration completed, {total} files updated")
+
+
 loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
+loop.run_until_complete(migrate() if '--migrate' in sys.argv[1:] else main())
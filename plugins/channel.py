@@ -1,7 +1,9 @@
 from pyrogram import Client, filters
 
 from info import CHANNELS
-from utils import save_file
+from utils import media_document
+from utils.helpers import get_media
+from utils.ingest import write_buffer
 
 media_filter = filters.document | filters.video | filters.audio
 
@@ -9,13 +11,8 @@ media_filter = filters.document | filters.video | filters.audio
 @Client.on_message(filters.chat(CHANNELS) & media_filter)
 async def media(bot, message):
     """Media Handler"""
-    for file_type in ("document", "video", "audio"):
-        media = getattr(message, file_type, None)
-        if media is not None:
-            break
-    else:
-        return
-
-    media.file_type = file_type
-    media.caption = message.caption
-    await save_file(media)
\ No newline at end of file
+    media = get_media(message)
+    if media is not None:
+        doc = media_document(media)
+        if doc is not None:
+            await write_buffer.put(doc)
\ No newline at end of file
@@ -1,11 +1,21 @@
 import os
+import re
+import time
 import logging
+from datetime import datetime
 
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from bson import ObjectId
 
-from info import START_MSG, CHANNELS, ADMINS, INVITE_MSG
-from utils import Media
+from info import START_MSG, CHANNELS, ADMINS, INVITE_MSG, id_pattern
+from utils import (
+    search_index, result_cache, migrate_media, dedupe_media, count_files, delete_media, purge_media, get_facets,
+    rebuild_facets,
+)
+from utils.helpers import get_media, throttled_progress
+from utils.facets import FACETS, parse_query
+from utils import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -59,13 +69,107 @@ async def total(bot, message):
     """Show total files in database"""
     msg = await message.reply("Processing...⏳", quote=True)
     try:
-        total = await Media.count_documents()
+        total = await count_files()
         await msg.edit(f'📁 Saved files: {total}')
     except Exception as e:
         logger.exception('Failed to check total files')
         await msg.edit(f'Error: {e}')
 
 
+@Client.on_message(filters.command('cache') & filters.user(ADMINS))
+async def cache_stats(bot, message):
+    """Show inline result cache counters"""
+    stats = result_cache.stats()
+    await message.reply(
+        f"**Result cache**\n\n"
+        f"Entries: {stats['size']}\n"
+        f"Hits: {stats['hits']} (prefix: {stats['prefix_hits']})\n"
+        f"Misses: {stats['misses']}\n"
+        f"Hit rate: {stats['hit_rate']:.1%}"
+    )
+
+
+@Client.on_message(filters.command('stats') & filters.user(ADMINS))
+async def stats(bot, message):
+    """Show search latency per stage and ingestion/database counters since start"""
+    uptime = max(time.time() - metrics.started, 1)
+    text = f"**Stats** (uptime {int(uptime // 3600)}h {int(uptime % 3600 // 60)}m)\n\n**Searches**\n"
+    latency, scanned = metrics.search_latency, metrics.search_scanned
+    for stage in sorted(latency.values, key=str):
+        text += (f"`{stage}`: {latency.count(stage)}, p50 {latency.percentile(50, stage)} ms, "
+                 f"p95 {latency.percentile(95, stage)} ms, scanned p95 {scanned.percentile(95, stage)}\n")
+
+    cache = result_cache.stats()
+    ingested = metrics.files_ingested.values
+    saved = ingested.get("saved", 0)
+    mongo = metrics.mongo_commands
+    text += (
+        f"\nIn-memory index: {len(search_index)} files\n"
+        f"Result cache hit rate: {cache['hit_rate']:.1%}\n"
+        f"\n**Ingestion**\n"
+        f"Saved: {saved} ({saved / uptime * 3600:.0f}/h), duplicates: {ingested.get('duplicate', 0)}\n"
+        f"Flushes: {metrics.flush_latency.count()}, p95 {metrics.flush_latency.percentile(95)} ms\n"
+        f"FloodWait: {metrics.flood_waits.total():.0f}s\n"
+        f"\n**MongoDB**\n"
+        f"Round trips: {mongo.total()} ({mongo.total() / uptime:.1f}/s)\n"
+    )
+    for command, n in sorted(mongo.values.items(), key=lambda item: -item[1])[:5]:
+        text += f"`{command}`: {n}, p95 {metrics.mongo_latency.percentile(95, command)} ms\n"
+    await message.reply(text)
+
+
+@Client.on_message(filters.command('facets') & filters.user(ADMINS))
+async def facet_counts(bot, message):
+    """Show file counts per type, mime type, size and channel, for all files or a query"""
+    msg = await message.reply("Processing...⏳", quote=True)
+    text = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
+    try:
+        if text == 'rebuild':
+            await rebuild_facets()
+            text = ""
+        query, file_type, size_range = parse_query(text)
+        counts = await get_facets(query, file_type, size_range)
+    except Exception as e:
+        logger.exception('Failed to count facets')
+        await msg.edit(f'Error: {e}')
+        return
+
+    reply = f"**Facets{' for ' + text if text else ''}**\n"
+    for facet in FACETS:
+        values = sorted(counts.get(facet, {}).items(), key=lambda item: -item[1])[:10]
+        if values:
+            reply += f"\n**{facet}**\n" + "\n".join(f"{value}: {count}" for value, count in values) + "\n"
+    await msg.edit(reply)
+
+
+@Client.on_message(filters.command('migrate') & filters.user(ADMINS))
+async def migrate(bot, message):
+    """Backfill search terms of files saved by older versions"""
+    msg = await message.reply("Processing...⏳", quote=True)
+    progress = throttled_progress(msg, 'Migrating... {} files updated')
+
+    try:
+        total = await migrate_media(progress=progress)
+        await msg.edit(f'Migration completed, {total} files updated')
+    except Exception as e:
+        logger.exception('Failed to migrate search terms')
+        await msg.edit(f'Error: {e}')
+
+
+@Client.on_message(filters.command('dedupe') & filters.user(ADMINS))
+async def dedupe(bot, message):
+    """Remove files saved more than once under different file ids"""
+    msg = await message.reply("Processing...⏳", quote=True)
+    progress = throttled_progress(msg, 'Deduplicating... {} duplicates removed')
+
+    try:
+        removed, fingerprinted = await dedupe_media(progress=progress)
+        await msg.edit(f'Dedupe completed, {removed} duplicates removed, {fingerprinted} files fingerprinted')
+    except Exception as e:
+        logger.exception('Failed to remove duplicates')
+        await msg.edit(f'Error: {e}')
+
+
 @Client.on_message(filters.command('logger') & filters.user(ADMINS))
 async def log_file(bot, message):
     """Send log file"""
@@ -85,23 +189,66 @@ async def delete(bot, message):
 
     msg = await message.reply("Processing...⏳", quote=True)
 
-    for file_type in ("document", "video", "audio"):
-        media = getattr(reply, file_type, None)
-        if media:
-            media.file_type = file_type
-            break
-    else:
+    media = get_media(reply)
+    if media is None:
         await msg.edit('This is not supported file format')
         return
 
-    result = await Media.collection.delete_one({
-        'file_name': media.file_name,
-        'file_size': media.file_size,
-        'file_type': media.file_type,
-        'mime_type': media.mime_type
-    })
+    deleted = await delete_media(media)
 
-    if result.deleted_count:
+    if deleted:
         await msg.edit('File is successfully deleted from database')
     else:
         await msg.edit('File not found in database')
+
+
+async def purge_filter(bot, mode, value):
+    """MongoDB filter of a /purge mode, raises ValueError for an unknown mode or a bad value"""
+    if mode == 'chat':
+        chat_id = int(value) if id_pattern.search(value) else (await bot.get_chat(value)).id
+        return {'chat_id': chat_id}
+    if mode == 'mime':
+        return {'mime_type': value}
+    if mode == 'regex':
+        re.compile(value)
+        return {'file_name': {'$regex': value, '$options': 'i'}}
+    if mode == 'before':
+        return {'created': {'$lt': ObjectId.from_datetime(datetime.strptime(value, '%Y-%m-%d'))}}
+    raise ValueError(f'Unknown purge mode {mode}')
+
+
+@Client.on_message(filters.command('purge') & filters.user(ADMINS))
+async def purge(bot, message):
+    """Delete every file of a channel, mime type, file name pattern or saved before a date"""
+    args = message.text.split(maxsplit=2)[1:]
+    confirmed = len(args) == 2 and args[1].endswith(' confirm')
+    if confirmed:
+        args[1] = args[1][:-len(' confirm')].strip()
+    if len(args) != 2:
+        await message.reply(
+            'Usage: `/purge chat -10012345678`, `/purge mime video/x-matroska`, '
+            '`/purge regex ^sample`, `/purge before 2021-01-31`\n'
+            'Add `confirm` at the end to delete the files instead of counting them.',
+            quote=True,
+        )
+        return
+
+    msg = await message.reply("Processing...⏳", quote=True)
+    try:
+        mongo_filter = await purge_filter(bot, args[0].lower(), args[1])
+        if not confirmed:
+            total = await count_files(mongo_filter)
+            await msg.edit(f'{total} files match, send the same command ending with `confirm` to delete them')
+            return
+    except Exception as e:
+        await msg.edit(f'Error: {e}')
+        return
+
+    progress = throttled_progress(msg, 'Purging... {} files deleted')
+
+    try:
+        deleted = await purge_media(mongo_filter, progress=progress)
+        await msg.edit(f'Purge completed, {deleted} files deleted')
+    except Exception as e:
+        logger.exception('Failed to purge files')
+        await msg.edit(f'Error: {e}')
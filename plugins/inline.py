@@ -1 +1,166 @@
-f
+import time
+import logging
+
+from pyrogram import Client, emoji, enums, filters
+from pyrogram.errors import UserNotParticipant
+from pyrogram.errors.exceptions.bad_request_400 import QueryIdInvalid
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultCachedDocument
+
+from utils import get_search_results, cached_search, result_cache, record_query, Overloaded
+from utils.facets import parse_query
+from utils.scheduling import SingleFlight, Debouncer, RateLimiter
+from utils.metrics import observe
+from info import CACHE_TIME, SHARE_BUTTON_TEXT, AUTH_USERS, AUTH_CHANNEL, INLINE_DEBOUNCE, INLINE_RATE, INLINE_BURST
+
+logger = logging.getLogger(__name__)
+cache_time = 0 if AUTH_USERS or AUTH_CHANNEL else CACHE_TIME
+max_results = 10
+flight = SingleFlight()
+debouncer = Debouncer(INLINE_DEBOUNCE)
+limiter = RateLimiter(INLINE_RATE, INLINE_BURST)
+# tokens a search costs per second it took, on top of the one taken to start it
+SEARCH_COST = 10
+observe("inline_shared_searches_total", "Searches answered by an identical in-flight search", lambda: flight.shared, "counter")
+observe("inline_debounced_total", "Inline updates dropped for a newer keystroke", lambda: debouncer.dropped, "counter")
+observe("inline_rate_limited_total", "Inline searches answered degraded for a user out of tokens", lambda: limiter.limited, "counter")
+
+
+@Client.on_inline_query(filters.user(AUTH_USERS) if AUTH_USERS else None)
+async def answer(bot, query):
+    """Show search results for given inline query"""
+
+    if AUTH_CHANNEL and not await is_subscribed(bot, query):
+        await query.answer(results=[],
+                           cache_time=0,
+                           switch_pm_text='You have to subscribe my channel to use the bot',
+                           switch_pm_parameter="subscribe")
+        return
+
+    string, file_type, size_range = parse_query(query.query)
+    filters = (file_type, size_range)
+
+    offset = query.offset or ""
+    # cache hits and recent files are cheap and never limited, searches cost the user tokens
+    cached = result_cache.lookup(string, filters, offset, max_results)
+    busy = False
+    if cached is None:
+        user_id = query.from_user.id
+        # first pages are typed keystroke by keystroke, only the last one is worth a search
+        if not offset and not await debouncer.wait(user_id):
+            return
+        if string and not limiter.allow(user_id):
+            cached, busy = await degraded(string, file_type, size_range), True
+        else:
+            key = result_cache.key(string, filters, offset, max_results)
+            started = time.monotonic()
+            try:
+                cached = await flight.do(key, search, string, file_type, size_range, offset)
+            except Overloaded:
+                cached, busy = await degraded(string, file_type, size_range), True
+            if string:
+                limiter.charge(user_id, (time.monotonic() - started) * SEARCH_COST)
+    if not offset:
+        # counted after the debouncer, so the prefixes typed on the way don't crowd out real queries
+        record_query(string, file_type, size_range)
+    files, next_offset = cached
+
+    reply_markup = get_reply_markup(bot.username, query=string)
+    results = []
+    for file in files:
+        results.append(
+            InlineQueryResultCachedDocument(
+                title=file['file_name'],
+                document_file_id=file['file_id'],
+                caption=file['caption'] or "",
+                description=f"Size: {get_size(file['file_size'])}\nType: {file['file_type']}",
+                reply_markup=reply_markup))
+
+    if busy:
+        # degraded answers are not cached by Telegram either, the same query gets a real search once possible
+        try:
+            await query.answer(results=results,
+                               is_personal=True,
+                               cache_time=0,
+                               switch_pm_text=f"{emoji.HOURGLASS_NOT_DONE} Busy, try again in a moment",
+                               switch_pm_parameter="start")
+        except QueryIdInvalid:
+            pass
+    elif results:
+        switch_pm_text = f"{emoji.FILE_FOLDER} Results"
+        if string:
+            switch_pm_text += f" for {string}"
+
+        try:
+            await query.answer(results=results,
+                               is_personal=True,
+                               cache_time=cache_time,
+                               switch_pm_text=switch_pm_text,
+                               switch_pm_parameter="start",
+                               next_offset=next_offset)
+        except QueryIdInvalid:
+            pass
+        except Exception as e:
+            logger.exception(str(e))
+            await query.answer(results=[],
+                               is_personal=True,
+                               cache_time=cache_time,
+                               switch_pm_text=str(e)[:63],
+                               switch_pm_parameter="error")
+    else:
+        switch_pm_text = f'{emoji.CROSS_MARK} No results'
+        if string:
+            switch_pm_text += f' for "{string}"'
+
+        await query.answer(results=[],
+                           is_personal=True,
+                           cache_time=cache_time,
+                           switch_pm_text=switch_pm_text,
+                           switch_pm_parameter="okay")
+
+
+async def search(string, file_type, size_range, offset):
+    return await cached_search(string, file_type=file_type, max_results=max_results, offset=offset,
+                               size_range=size_range)
+
+
+async def degraded(string, file_type, size_range):
+    """Cheap answer for a search that can't run now: matches from a cached shorter query, else the newest files"""
+    files = result_cache.nearest(string, (file_type, size_range), max_results)
+    if not files:
+        files, _ = await get_search_results("", file_type=file_type, max_results=max_results, recent=True,
+                                            size_range=size_range)
+    return files, ""
+
+
+def get_reply_markup(username, query):
+    buttons = [[
+        InlineKeyboardButton('Search again', switch_inline_query_current_chat=query),
+        InlineKeyboardButton('Share bot', url=f"https://t.me/share/url?url={SHARE_BUTTON_TEXT.format(username=username)}"),
+    ]]
+    return InlineKeyboardMarkup(buttons)
+
+
+def get_size(size):
+    """Get size in readable format"""
+
+    units = ["Bytes", "KB", "MB", "GB", "TB", "PB", "EB"]
+    size = float(size or 0)
+    i = 0
+    while size >= 1024.0 and i < len(units) - 1:
+        i += 1
+        size /= 1024.0
+    return "%.2f %s" % (size, units[i])
+
+
+async def is_subscribed(bot, query):
+    try:
+        user = await bot.get_chat_member(AUTH_CHANNEL, query.from_user.id)
+    except UserNotParticipant:
+        pass
+    except Exception as e:
+        logger.exception(e)
+    else:
+        if user.status != enums.ChatMemberStatus.BANNED:
+            return True
+
+    return False
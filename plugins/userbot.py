@@ -2,56 +2,69 @@ import logging
 import asyncio
 
 from pyrogram import Client, filters
-from pyrogram.errors import FloodWait
 
-from info import USERBOT_STRING_SESSION, API_ID, API_HASH, ADMINS, id_pattern
-from utils import save_file
+from info import USERBOT_STRING_SESSION, API_ID, API_HASH, ADMINS, INDEX_CONCURRENCY, id_pattern
+from utils.ingest import IndexJob
+from utils.scheduling import FloodScheduler
 
 logger = logging.getLogger(__name__)
-lock = asyncio.Lock()
+semaphore = asyncio.Semaphore(INDEX_CONCURRENCY)
+scheduler = FloodScheduler()
+running = set()
+progress_interval = 20
 
 
 @Client.on_message(filters.command(['index', 'indexfiles']) & filters.user(ADMINS))
 async def index_files(bot, message):
-    """Save channel or group files with the help of user bot"""
+    """Save channel or group files with the help of user bot, `/index new ...` only saves files posted since last index"""
+
+    raw_data = message.command[1:]
+    incremental = bool(raw_data) and raw_data[0].lower() == 'new'
+    if incremental:
+        raw_data = raw_data[1:]
+    chats = [int(chat) if id_pattern.search(chat) else chat for chat in raw_data]
+    busy = [chat for chat in chats if chat in running]
 
     if not USERBOT_STRING_SESSION:
         await message.reply('Set `USERBOT_STRING_SESSION` in info.py file or in environment variables.')
-    elif len(message.command) == 1:
-        await message.reply('Please specify channel username or id in command.\n\nExample: `/index -10012345678`')
-    elif lock.locked():
-        await message.reply('Wait until previous process complete.')
+    elif not chats:
+        await message.reply('Please specify channel username or id in command.\n\n'
+                            'Example: `/index -10012345678`\nOnly new files: `/index new -10012345678`')
+    elif busy:
+        await message.reply(f'Wait until previous process of {", ".join(map(str, busy))} complete.')
     else:
         msg = await message.reply('Processing...⏳')
-        raw_data = message.command[1:]
-        user_bot = Client('User-bot', API_ID, API_HASH, session_string=USERBOT_STRING_SESSION)
-        chats = [int(chat) if id_pattern.search(chat) else chat for chat in raw_data]
-        total_files = 0
-
-        async with lock:
-            try:
-                async with user_bot:
-                    for chat in chats:
-
-                        async for user_message in user_bot.get_chat_history(chat):
-                            try:
-                                message = await bot.get_messages(chat, user_message.id, replies=0)
-                            except FloodWait as e:
-                                await asyncio.sleep(e.value)
-                                message = await bot.get_messages(chat, user_message.id, replies=0)
-
-                            for file_type in ("document", "video", "audio"):
-                                media = getattr(message, file_type, None)
-                                if media is not None:
-                                    break
-                            else:
-                                continue
-                            media.file_type = file_type
-                            media.caption = message.caption
-                            await save_file(media)
-                            total_files += 1
-            except Exception as e:
-                logger.exception(e)
-                await msg.edit(f'Error: {e}')
-            else:
-                await msg.edit(f'Total {total_files} checked!')
+        user_bot = Client('User-bot', API_ID, API_HASH, session_string=USERBOT_STRING_SESSION, in_memory=True)
+        jobs = [IndexJob(user_bot, bot, chat, scheduler, incremental=incremental) for chat in chats]
+        running.update(chats)
+
+        async def run(job):
+            async with semaphore:
+                await job.run()
+
+        reporter = asyncio.ensure_future(report(msg, jobs))
+        try:
+            async with user_bot:
+                await asyncio.gather(*(run(job) for job in jobs))
+        except Exception as e:
+            logger.exception(e)
+            await msg.edit(f'Error: {e}\n\n' + progress_text(jobs) + '\n\nRun the same command again to resume.')
+        else:
+            await msg.edit('Indexing completed!\n\n' + progress_text(jobs))
+        finally:
+            reporter.cancel()
+            running.difference_update(chats)
+
+
+def progress_text(jobs):
+    return '\n'.join(job.progress() for job in jobs)
+
+
+async def report(msg, jobs):
+    """Edit the status message with the progress of every job periodically"""
+    while True:
+        await asyncio.sleep(progress_interval)
+        try:
+            await msg.edit('Indexing...⏳\n\n' + progress_text(jobs))
+        except Exception as e:
+            logger.warning(f'Failed to update index progress: {e}')
@@ -9,6 +9,28 @@ USERBOT_STRING_SESSION = ''
 # Bot settings
 CACHE_TIME = 300
 USE_CAPTION_FILTER = False
+RANK_CANDIDATES = 500
+DUPLICATE_DISTANCE = 0
+SPELL_DISTANCE = 2
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 60
+NEGATIVE_CACHE_SIZE = 10000
+NEGATIVE_CACHE_TTL = 600
+PREWARM_QUERIES = 200
+PREWARM_INTERVAL = 45
+INLINE_DEBOUNCE = 0.3
+INLINE_RATE = 1
+INLINE_BURST = 10
+EXPENSIVE_SEARCHES = 4
+INDEX_CONCURRENCY = 2
+WRITE_BUFFER_SIZE = 500
+WRITE_BUFFER_DELAY = 1
+METRICS_PORT = 0
+SEARCH_WORKERS = 0
+INDEX_SNAPSHOT = ''
+INDEX_SNAPSHOT_INTERVAL = 3600
+WATCH_CHANGES = False
+CHANGES_POLL_INTERVAL = 10
 
 # Admins, Channels & Users
 ADMINS = [12345789, 'admin123', 98765432]
@@ -20,6 +42,11 @@ AUTH_CHANNEL = None
 DATABASE_URI = "mongodb://[username:password@]host1[:port1][,...hostN[:portN]][/[defaultauthdb]?retryWrites=true&w=majority"
 DATABASE_NAME = 'Telegram'
 COLLECTION_NAME = 'channel_files'  # If you are using the same database, then use different collection name for each bot
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+MONGO_TIMEOUT_MS = 5000
+SEARCH_TIME_LIMIT_MS = 2000
+SEARCH_READ_PREFERENCE = 'primary'
 
 # Messages
 START_MSG = """
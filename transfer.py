@@ -0,0 +1,60 @@
+"""
+Export saved files to a compressed file and import them into another database, to move or rebuild
+the database in minutes instead of indexing channels again.
+
+    python3 transfer.py export media.bson.gz
+    python3 transfer.py export newer.bson.gz --since <watermark printed by the previous export>
+    python3 transfer.py import media.bson.gz
+"""
+import logging
+import logging.config
+
+# Get logging configurations
+logging.config.fileConfig('logging.conf')
+logging.getLogger().setLevel(logging.WARNING)
+
+import argparse
+import asyncio
+from bson import ObjectId
+from utils import export_media, import_media
+
+
+async def export(args):
+    async def progress(done):
+        print(f"{done} files exported", end="\r")
+
+    since = ObjectId(args.since) if args.since else None
+    total, watermark = await export_media(args.path, since=since, progress=progress)
+    print(f"Exported {total} files to {args.path}")
+    if watermark is not None:
+        print(f"Export the files saved after these with --since {watermark}")
+
+
+async def restore(args):
+    async def progress(done):
+        print(f"{done} files read", end="\r")
+
+    inserted, skipped = await import_media(args.path, args.batch_size, args.parallel, progress=progress)
+    print(f"Imported {inserted} files, {skipped} were already saved")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    exporter = commands.add_parser("export", help="write saved files to a file")
+    exporter.add_argument("path")
+    exporter.add_argument("--since", help="only files saved after this watermark of a previous export")
+    exporter.set_defaults(run=export)
+    importer = commands.add_parser("import", help="save the files of an export file")
+    importer.add_argument("path")
+    importer.add_argument("--batch-size", type=int, default=1000, help="documents per insert")
+    importer.add_argument("--parallel", type=int, default=4, help="inserts running at the same time")
+    importer.set_defaults(run=restore)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
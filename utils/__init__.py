@@ -1,2 +1,9 @@
 from .helpers import unpack_new_file_id
-from .database import Media, save_file, get_search_results
\ No newline at end of file
+from .database import (
+    Media, media_document, save_file, insert_documents, get_search_results, build_search_index,
+    save_search_snapshot, build_gram_filter, use_search_workers, delete_file, delete_media, purge_media, get_facets,
+    rebuild_facets, search_index, spelling, ensure_indexes, result_cache, negative_cache, migrate_media, dedupe_media,
+    count_files, change_bus, watch_changes, record_query, prewarm_queries, export_media, import_media,
+    cached_search,
+)
+from .scheduling import Overloaded
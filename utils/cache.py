@@ -0,0 +1,267 @@
+import time
+from collections import OrderedDict
+
+from .search_index import normalize, build_regex, trigrams
+from .facets import accepts
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after they were stored"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.data[key]
+            self.evicted(key, value)
+            return None
+        self.data.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            old_key, (_, old_value) = self.data.popitem(last=False)
+            self.evicted(old_key, old_value)
+
+    def evicted(self, key, value):
+        """Called for entries dropped because they expired or the cache was full"""
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class ResultCache(TTLCache):
+    """
+    Cache of (results, next_offset) pages keyed on (query, filters, offset, max_results),
+    `filters` being anything hashable that narrows results besides the query, like (file_type, size_range).
+    A first page stored as complete, holding every match rather than what a scan limit let through,
+    also answers every longer query typed after it: "avat" can only match a subset of what "ava"
+    matched, so it is filtered locally instead of searching again.
+    Like NegativeCache entries, pages are filed under one trigram of their query so a new file only
+    checks the queries it could match, queries without trigrams are filed under None and always checked.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, use_caption=False):
+        super().__init__(maxsize, ttl)
+        self.use_caption = use_caption
+        self.prefix_hits = 0
+        # trigram (or None) -> keys of the pages filed under it
+        self.buckets = {}
+
+    @staticmethod
+    def key(query, filters, offset, max_results):
+        return normalize(query), filters, offset or "", max_results
+
+    def _filter(self, files, query):
+        _, regex = build_regex(query)
+        return [
+            file for file in files
+            if regex.search(file["file_name"] or "") or (self.use_caption and regex.search(file["caption"] or ""))
+        ]
+
+    def lookup(self, query, filters, offset, max_results):
+        """Return cached (results, next_offset) or None"""
+        key = self.key(query, filters, offset, max_results)
+        entry = self._get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1][0]
+
+        q = key[0]
+        if not offset and q:
+            seen = set()
+            for end in range(len(q) - 1, 0, -1):
+                prefix = q[:end].strip()
+                if not prefix or prefix in seen:
+                    continue
+                seen.add(prefix)
+                entry = self._get((prefix, filters, "", max_results))
+                if entry is not None and entry[1][1]:
+                    self.hits += 1
+                    self.prefix_hits += 1
+                    result = (self._filter(entry[1][0][0], q), "")
+                    self.set(key, (result, True))
+                    return result
+
+        self.misses += 1
+        return None
+
+    def nearest(self, query, filters, max_results):
+        """
+        Files of the longest cached first page of a prefix of `query` that match it, or None.
+        Unlike lookup, pages that were not complete are used too: a degraded answer for when searching costs too much.
+        """
+        q = normalize(query)
+        for end in range(len(q) - 1, 0, -1):
+            entry = self._get((q[:end].strip(), filters, "", max_results))
+            if entry is not None:
+                return self._filter(entry[1][0][0], q)
+        return None
+
+    def store(self, query, filters, offset, max_results, result, complete=False):
+        """Cache a (results, next_offset) page, `complete` if it is the last page of every match"""
+        self.set(self.key(query, filters, offset, max_results), (result, complete))
+
+    @staticmethod
+    def _gram(query):
+        parts, _ = build_regex(query)
+        grams = set()
+        for part in parts:
+            grams.update(trigrams(part))
+        return min(grams) if grams else None
+
+    def set(self, key, value):
+        super().set(key, value)
+        self.buckets.setdefault(self._gram(key[0]), set()).add(key)
+
+    def evicted(self, key, value):
+        gram = self._gram(key[0])
+        bucket = self.buckets.get(gram)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[gram]
+
+    def _drop(self, key):
+        self.evicted(key, self.data.pop(key)[1])
+
+    def invalidate(self, file_ids):
+        """Drop the cached pages showing any of `file_ids`, returns how many"""
+        file_ids = set(file_ids)
+        stale = [key for key, (_, ((files, _), _)) in self.data.items() if any(f["file_id"] in file_ids for f in files)]
+        for key in stale:
+            self._drop(key)
+        return len(stale)
+
+    def invalidate_matches(self, doc):
+        """Drop the cached pages of every query a newly saved raw Media document matches, returns how many"""
+        if not self.buckets:
+            return 0
+        texts = [doc.get("file_name") or ""]
+        if self.use_caption:
+            texts.append(doc.get("caption") or "")
+        stale = set()
+        for gram in (None, *(doc.get("search_grams") or ())):
+            for key in self.buckets.get(gram, ()):
+                _, regex = build_regex(key[0])
+                if any(regex.search(text) for text in texts):
+                    stale.add(key)
+        for key in stale:
+            if key in self.data:
+                self._drop(key)
+        return len(stale)
+
+    def clear(self):
+        super().clear()
+        self.buckets.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats["prefix_hits"] = self.prefix_hits
+        return stats
+
+
+class NegativeCache(TTLCache):
+    """
+    (normalized query, file_type, size_range) known to match nothing.
+    Every entry is also filed under one trigram of its query: a file can only match a query
+    if it contains all of the query's trigrams, so `invalidate` only has to check the entries
+    filed under the new file's own trigrams. Queries without trigrams are never cached.
+    """
+
+    def __init__(self, maxsize=10000, ttl=600, use_caption=False):
+        super().__init__(maxsize, ttl)
+        self.use_caption = use_caption
+        # trigram -> keys of the entries filed under it
+        self.buckets = {}
+        self.invalidated = 0
+
+    @staticmethod
+    def _key(query, file_type, size_range):
+        parts, regex = build_regex(query)
+        grams = set()
+        for part in parts:
+            grams.update(trigrams(part))
+        return (" ".join(parts), file_type, size_range), grams, regex
+
+    def contains(self, query, file_type=None, size_range=None):
+        key, grams, _ = self._key(query, file_type, size_range)
+        return bool(grams) and self.get(key) is not None
+
+    def add(self, query, file_type=None, size_range=None):
+        key, grams, regex = self._key(query, file_type, size_range)
+        if not grams:
+            return
+        gram = min(grams)
+        self.set(key, (gram, regex))
+        self.buckets.setdefault(gram, set()).add(key)
+
+    def evicted(self, key, value):
+        bucket = self.buckets.get(value[0])
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[value[0]]
+
+    def invalidate(self, doc):
+        """Forget the cached misses a newly saved raw Media document matches"""
+        if not self.buckets:
+            return
+        texts = [doc.get("file_name") or ""]
+        if self.use_caption:
+            texts.append(doc.get("caption") or "")
+        for gram in doc.get("search_grams") or ():
+            bucket = self.buckets.get(gram)
+            if not bucket:
+                continue
+            for key in list(bucket):
+                entry = self.data.get(key)
+                if entry is None:
+                    bucket.discard(key)
+                    continue
+                if not accepts(doc, key[1], key[2]):
+                    continue
+                regex = entry[1][1]
+                if any(regex.search(text) for text in texts):
+                    del self.data[key]
+                    self.evicted(key, entry[1])
+                    self.invalidated += 1
+
+    def clear(self):
+        super().clear()
+        self.buckets.clear()
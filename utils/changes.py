@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# code of the error standalone servers answer a change stream with
+NOT_REPLICA_SET = 40573
+# polling reads this far back again, writers stamp `created` and deletions before the write reaches the server
+POLL_LAG = timedelta(minutes=1)
+# documents read per query while polling, so a large /index or migration is never loaded at once
+POLL_BATCH = 1000
+
+
+class ChangeBus:
+    """
+    Fans out files saved or deleted by any bot instance to subscribers, so in-process indexes and
+    caches follow changes made elsewhere. Subscribers are coroutine functions taking a list of raw
+    Media documents (saved) or of file ids (deleted). A failing subscriber is logged and skipped.
+    """
+
+    def __init__(self):
+        self.saved = []
+        self.deleted = []
+
+    def subscribe(self, saved=None, deleted=None):
+        if saved is not None:
+            self.saved.append(saved)
+        if deleted is not None:
+            self.deleted.append(deleted)
+
+    @staticmethod
+    async def _publish(subscribers, items):
+        for subscriber in subscribers:
+            try:
+                await subscriber(items)
+            except Exception:
+                logger.exception(f"Change subscriber {subscriber.__qualname__} failed")
+
+    async def publish_saved(self, docs):
+        await self._publish(self.saved, docs)
+
+    async def publish_deleted(self, file_ids):
+        await self._publish(self.deleted, file_ids)
+
+
+async def watch(collection, deletions, bus, projection, poll_interval):
+    """
+    Publish every file inserted into or deleted from `collection` to `bus` until cancelled.
+    Changes come from a change stream, resumed after errors, or from `poll` on servers
+    that are not part of a replica set.
+    """
+    since = ObjectId()
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "delete"]}}},
+        {"$project": {"operationType": 1, "documentKey": 1, **{f"fullDocument.{key}": 1 for key in projection}}},
+    ]
+    resume_after = None
+    while True:
+        try:
+            async with collection.watch(pipeline, resume_after=resume_after) as stream:
+                logger.info("Watching file changes with a change stream")
+                async for change in stream:
+                    resume_after = stream.resume_token
+                    if change["operationType"] == "insert":
+                        await bus.publish_saved([change["fullDocument"]])
+                    else:
+                        await bus.publish_deleted([change["documentKey"]["_id"]])
+        except OperationFailure as e:
+            if e.code == NOT_REPLICA_SET:
+                break
+            # the resume token may be too old to resume from, start over from the current changes
+            logger.warning(f"Change stream failed, restarting it: {e}")
+            resume_after = None
+        except PyMongoError as e:
+            logger.warning(f"Change stream interrupted, resuming it: {e}")
+        await asyncio.sleep(poll_interval)
+
+    logger.info(f"Change streams need a replica set, polling file changes every {poll_interval}s instead")
+    await poll(collection, deletions, bus, projection, poll_interval, since)
+
+
+async def poll(collection, deletions, bus, projection, interval, since):
+    """
+    Publish files with a `created` and deletions logged after `since`, every `interval` seconds.
+    Each poll reads POLL_LAG back for writes stamped earlier but committed late, files and
+    deletions published in that window are remembered and not published twice.
+    Changes are read and published POLL_BATCH at a time.
+    """
+    published = TTLCache(maxsize=100000, ttl=3 * POLL_LAG.total_seconds())
+    saved_after = deleted_after = since
+
+    async def read(col, key, after, projection, publish):
+        """Publish the documents of `col` whose `key` is after `after` minus POLL_LAG, returns the last key read"""
+        last = after
+        after = ObjectId.from_datetime(after.generation_time - POLL_LAG)
+        while True:
+            batch = await col.find({key: {"$gt": after}}, projection).sort(key, 1).limit(POLL_BATCH).to_list(None)
+            if not batch:
+                return last
+            after = batch[-1][key]
+            last = max(last, after)
+            new = [item for item in batch if published.get(item["_id"]) is None]
+            for item in new:
+                published.set(item["_id"], True)
+            if new:
+                await publish(new)
+            if len(batch) < POLL_BATCH:
+                return last
+
+    async def publish_deleted(logged):
+        await bus.publish_deleted([deletion["file_id"] for deletion in logged])
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            saved_after = await read(collection, "created", saved_after, projection, bus.publish_saved)
+            deleted_after = await read(deletions, "_id", deleted_after, None, publish_deleted)
+        except PyMongoError as e:
+            logger.warning(f"Polling file changes failed: {e}")
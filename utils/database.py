@@ -1,20 +1,112 @@
 import re
+import time
+import asyncio
 import logging
+from datetime import datetime, timezone
 
-from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+from pymongo import UpdateOne, ReadPreference
+from pymongo.errors import BulkWriteError, ExecutionTimeout
 from umongo import Instance, Document, fields
 from motor.motor_asyncio import AsyncIOMotorClient
 from marshmallow.exceptions import ValidationError
 
-from info import DATABASE_URI, DATABASE_NAME, COLLECTION_NAME, USE_CAPTION_FILTER
+from info import (
+    DATABASE_URI, DATABASE_NAME, COLLECTION_NAME, USE_CAPTION_FILTER, RESULT_CACHE_SIZE, RESULT_CACHE_TTL,
+    RANK_CANDIDATES, DUPLICATE_DISTANCE, SPELL_DISTANCE, NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL,
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_TIMEOUT_MS, SEARCH_TIME_LIMIT_MS, SEARCH_READ_PREFERENCE,
+    INDEX_SNAPSHOT, CHANGES_POLL_INTERVAL, PREWARM_QUERIES, PREWARM_INTERVAL, EXPENSIVE_SEARCHES,
+)
 from .helpers import unpack_new_file_id
+from .search_index import SearchIndex, build_regex, normalize, search_terms, trigrams
+from .workers import INDEX_PROJECTION, index_page
+from .snapshot import DELETIONS_TTL, open_snapshot, write_snapshot, catch_up_filters
+from .pagination import query_fingerprint, encode_offset, decode_offset, key_source
+from .ranking import rank
+from .spelling import SpellChecker
+from .bloom import BloomFilter
+from .dedupe import fingerprint, same_file
+from .facets import SIZE_BOUNDS, SIZE_LABELS, FACETS, accepts, size_filter, count_facets
+from .metrics import (
+    SearchTrace, CommandMetrics, current_trace, record_search, record_complete, observe, search_latency, search_scanned,
+    files_ingested,
+)
+from .cache import TTLCache, ResultCache, NegativeCache
+from .changes import ChangeBus, watch
+from .popularity import QueryLog
+from .scheduling import ConcurrencyLimit, Overloaded
+from .transfer import WATERMARK_MARGIN, export_documents, import_documents
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-client = AsyncIOMotorClient(DATABASE_URI)
+client = AsyncIOMotorClient(
+    DATABASE_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_TIMEOUT_MS,
+    event_listeners=[CommandMetrics()],
+)
 database = client[DATABASE_NAME]
+_read_preferences = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+search_read_preference = {name.lower(): mode for name, mode in _read_preferences.items()}.get(
+    SEARCH_READ_PREFERENCE.strip().lower()
+)
+if search_read_preference is None:
+    raise ValueError(
+        f"Invalid SEARCH_READ_PREFERENCE {SEARCH_READ_PREFERENCE!r}, use one of: {', '.join(_read_preferences)}"
+    )
 instance = Instance.from_db(database)
+checkpoints = database[COLLECTION_NAME + "_checkpoints"]
+# materialized facet counters, {"_id": "facet:value", "facet": facet, "value": value, "count": n}
+facets = database[COLLECTION_NAME + "_facets"]
+# {"_id": ObjectId, "file_id": file_id} of every removed file, so snapshots taken before can catch up
+deletions = database[COLLECTION_NAME + "_deletions"]
+# {"_id": "top", "queries": [[[query, file_type, size_range], count], ...]}, query_log of the previous run
+queries = database[COLLECTION_NAME + "_queries"]
+search_index = SearchIndex(use_caption=USE_CAPTION_FILTER)
+# SearchWorkers answering index pages instead of search_index, see use_search_workers
+search_workers = None
+spelling = SpellChecker(max_distance=SPELL_DISTANCE)
+result_cache = ResultCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, use_caption=USE_CAPTION_FILTER)
+negative_cache = NegativeCache(maxsize=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL, use_caption=USE_CAPTION_FILTER)
+# Bloom filter of every stored search gram, None until build_gram_filter ran
+gram_filter = None
+# whether every file has search terms and `created`, until then the indexed lookup would miss files
+_migrated = False
+# grams of files saved while build_gram_filter is running
+_gram_backlog = None
+# files saved or deleted by any bot instance, see watch_changes
+change_bus = ChangeBus()
+# ids of files inserted by this process, so their change events are not applied twice
+_saved_here = TTLCache(maxsize=100000, ttl=600)
+# (normalized query, file_type, size_range) of inline first pages, see prewarm_queries
+query_log = QueryLog(capacity=5 * PREWARM_QUERIES)
+# hot query key -> regex, and the hot queries a file saved since their last refresh matches
+_hot = {}
+_stale = set()
+_stale_event = None
+# searches past the indexed stages, which read the collection itself
+expensive_searches = ConcurrencyLimit(EXPENSIVE_SEARCHES)
+
+observe("search_index_files", "Files in the in-memory search index", lambda: len(search_index))
+observe("expensive_searches", "Searches reading the collection right now", lambda: expensive_searches.running)
+observe("expensive_searches_shed_total", "Searches refused as too many were running", lambda: expensive_searches.shed, "counter")
+observe("prewarmed_queries", "Queries whose first page is kept in the inline cache", lambda: len(_hot))
+observe("spelling_words", "Words known to the typo correction", lambda: len(spelling))
+observe("inline_cache_entries", "Pages in the inline result cache", lambda: len(result_cache))
+observe("inline_cache_hits_total", "Inline result cache hits", lambda: result_cache.hits, "counter")
+observe("inline_cache_prefix_hits_total", "Inline result cache hits from a shorter query", lambda: result_cache.prefix_hits, "counter")
+observe("inline_cache_misses_total", "Inline result cache misses", lambda: result_cache.misses, "counter")
+observe("negative_cache_entries", "Queries cached as matching nothing", lambda: len(negative_cache))
+observe("negative_cache_hits_total", "Searches answered by the negative cache", lambda: negative_cache.hits, "counter")
 
 
 @instance.register
@@ -26,49 +118,815 @@ class Media(Document):
     file_type = fields.StrField(allow_none=True)
     mime_type = fields.StrField(allow_none=True)
     caption = fields.StrField(allow_none=True)
+    search_tokens = fields.ListField(fields.StrField())
+    search_grams = fields.ListField(fields.StrField())
+    created = fields.ObjectIdField()
+    fingerprint = fields.IntField()
+    chat_id = fields.IntField(allow_none=True)
 
     class Meta:
-        indexes = ('$file_name', )
+        indexes = (
+            '$file_name', '-created', ('search_tokens', '-created'), ('search_grams', '-created'), 'file_size',
+            ('file_type', '-created'), ('file_name', 'file_size'),
+            # partial, so files saved before fingerprints existed don't conflict until dedupe_media ran
+            {'key': ['fingerprint'], 'unique': True, 'partialFilterExpression': {'fingerprint': {'$exists': True}}},
+        )
         collection_name = COLLECTION_NAME
 
 
-async def save_file(media):
-    """Save file in database"""
+# Lean validation for hot ingestion paths: mongo field -> (accepted types, required), mirrors Media
+MEDIA_SCHEMA = {
+    "_id": (str, True),
+    "file_ref": (str, False),
+    "file_name": (str, True),
+    "file_size": (int, True),
+    "file_type": (str, False),
+    "mime_type": (str, False),
+    "caption": (str, False),
+    "search_tokens": (list, False),
+    "search_grams": (list, False),
+    "created": (ObjectId, False),
+    "fingerprint": (int, False),
+    "chat_id": (int, False),
+}
+_schema_checks = tuple((name, types, required) for name, (types, required) in MEDIA_SCHEMA.items())
+
+
+def validate_document(doc):
+    """Raise ValidationError if a raw Media document doesn't match MEDIA_SCHEMA"""
+    errors = {}
+    for name, types, required in _schema_checks:
+        value = doc.get(name)
+        if value is None:
+            if required:
+                errors[name] = ["Missing data for required field."]
+        elif not isinstance(value, types) or isinstance(value, bool):
+            errors[name] = [f"Not a valid {types.__name__}."]
+    if errors:
+        raise ValidationError(errors)
+
+
+def media_document(media):
+    """Return a raw Media document ready for pymongo for a pyrogram media object, or None if it is invalid"""
 
     file_id, file_ref = unpack_new_file_id(media.file_id)
+    caption = media.caption.html if media.caption else None
+    tokens, grams = search_terms(media.file_name, caption if USE_CAPTION_FILTER else None)
+    doc = {
+        "_id": file_id,
+        "file_ref": file_ref,
+        "file_name": media.file_name,
+        "file_size": media.file_size,
+        "file_type": media.file_type,
+        "mime_type": media.mime_type,
+        "caption": caption,
+        "search_tokens": tokens,
+        "search_grams": grams,
+        "created": ObjectId(),
+        "fingerprint": fingerprint(media.file_name, media.file_size, media.mime_type),
+        "chat_id": getattr(media, "chat_id", None),
+    }
 
     try:
-        file = Media(
-            file_id=file_id,
-            file_ref=file_ref,
-            file_name=media.file_name,
-            file_size=media.file_size,
-            file_type=media.file_type,
-            mime_type=media.mime_type,
-            caption=media.caption.html if media.caption else None,
-        )
+        validate_document(doc)
     except ValidationError:
         logger.exception('Error occurred while saving file in database')
     else:
-        try:
-            await file.commit()
-        except DuplicateKeyError:
+        return doc
+
+
+async def save_file(media):
+    """Save file in database"""
+
+    doc = media_document(media)
+    if doc is not None:
+        if await insert_documents([doc]):
+            logger.info(media.file_name + " is saved in database")
+        else:
             logger.warning(media.file_name + " is already saved in database")
+
+
+async def find_duplicates(docs):
+    """
+    Return the indexes of raw Media documents that are already saved, or repeat an earlier one of `docs`,
+    possibly under another file_id: same size and mime type, and the same or a nearly same name.
+    """
+    groups = {}
+    projection = {"file_name": 1, "file_size": 1, "mime_type": 1, "fingerprint": 1}
+    sizes = list({doc["file_size"] for doc in docs})
+    async for saved in database[COLLECTION_NAME].find({"file_size": {"$in": sizes}}, projection):
+        groups.setdefault((saved["file_size"], saved.get("mime_type")), []).append(saved)
+
+    duplicates = set()
+    for i, doc in enumerate(docs):
+        group = groups.setdefault((doc["file_size"], doc.get("mime_type")), [])
+        if any(same_file(doc, other, DUPLICATE_DISTANCE) for other in group):
+            duplicates.add(i)
         else:
-            logger.info(media.file_name + " is saved in database")
+            group.append(doc)
+    return duplicates
+
+
+async def insert_documents(docs):
+    """
+    Insert raw Media documents with one unordered insert_many.
+    Already saved files and duplicates are skipped, returns the documents that were inserted.
+    """
+    if not docs:
+        return []
+
+    duplicates = await find_duplicates(docs)
+    unique = [doc for i, doc in enumerate(docs) if i not in duplicates]
+    failed = set()
+    try:
+        if unique:
+            await database[COLLECTION_NAME].insert_many(unique, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            failed.add(error["index"])
+            if error.get("code") != 11000:
+                logger.error(f"Failed to save {unique[error['index']].get('file_name')}: {error.get('errmsg')}")
+
+    inserted = [doc for i, doc in enumerate(unique) if i not in failed]
+    for doc in inserted:
+        _saved_here.set(doc["_id"], True)
+    await _remember(inserted)
+    await update_facets(inserted)
+    files_ingested.inc(len(inserted), label="saved")
+    files_ingested.inc(len(docs) - len(inserted), label="duplicate")
+    logger.info(f"Saved {len(inserted)} of {len(docs)} files in database")
+    return inserted
+
+
+async def delete_file(mongo_filter):
+    """Delete one Media document matching `mongo_filter` everywhere it is known, returns it or None"""
+    projection = {"file_name": 1, "file_size": 1, "file_type": 1, "mime_type": 1, "chat_id": 1}
+    deleted = await database[COLLECTION_NAME].find_one_and_delete(mongo_filter, projection=projection)
+    if deleted:
+        await _forget([deleted])
+    return deleted
+
+
+async def _remember(docs):
+    """Add saved Media documents to the search index, typo correction vocabulary, gram filter and query caches"""
+    await _index_add(docs)
+    for doc in docs:
+        _learn_words(doc)
+        negative_cache.invalidate(doc)
+        result_cache.invalidate_matches(doc)
+        if gram_filter is not None:
+            gram_filter.update(doc.get("search_grams") or ())
+        elif _gram_backlog is not None:
+            _gram_backlog.update(doc.get("search_grams") or ())
+        if _hot:
+            _mark_stale(doc)
+
+
+async def delete_media(media):
+    """
+    Delete the Media document of a pyrogram media object, returns it or None.
+    Looked up by its decoded file id, then by name and size (on the file_name/file_size index)
+    for files saved from another account, whose file ids differ.
+    """
+    file_id, _ = unpack_new_file_id(media.file_id)
+    deleted = await delete_file({"_id": file_id})
+    if deleted is None:
+        deleted = await delete_file({
+            "file_name": media.file_name,
+            "file_size": media.file_size,
+            "file_type": media.file_type,
+            "mime_type": media.mime_type,
+        })
+    return deleted
+
+
+async def purge_media(mongo_filter, batch_size=500, delay=1, progress=None):
+    """
+    Delete every Media document matching `mongo_filter` in batches of `batch_size`,
+    sleeping `delay` seconds between batches so searches and saves keep their share of the database.
+    The filter is run once, each batch is deleted by _id. `progress` is awaited with the number
+    of documents deleted so far after every batch. Returns the number deleted.
+    """
+    col = database[COLLECTION_NAME]
+    projection = {"file_name": 1, "file_size": 1, "file_type": 1, "mime_type": 1, "chat_id": 1}
+    deleted = 0
+    batch = []
+
+    async def flush():
+        nonlocal deleted
+        result = await col.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        await _forget(batch)
+        deleted += result.deleted_count
+        batch.clear()
+        if progress is not None:
+            await progress(deleted)
+
+    async for doc in col.find(mongo_filter, projection).batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await flush()
+            await asyncio.sleep(delay)
+    if batch:
+        await flush()
+    return deleted
+
+
+async def _forget(docs):
+    """Log deleted Media documents and remove them from the search index, facet counters and cached pages"""
+    file_ids = [doc["_id"] for doc in docs]
+    if not file_ids:
+        return
+    deleted = datetime.now(timezone.utc)
+    await deletions.insert_many([{"file_id": str(file_id), "deleted": deleted} for file_id in file_ids])
+    await _index_remove(file_ids)
+    await update_facets(docs, -1)
+    result_cache.invalidate(str(file_id) for file_id in file_ids)
+
+
+async def _saved_elsewhere(docs):
+    await _remember([doc for doc in docs if _saved_here.get(doc["_id"]) is None])
+
+
+async def _deleted_elsewhere(file_ids):
+    # deletions made here come back too, removing a file twice is a no-op
+    await _index_remove(file_ids)
+    result_cache.invalidate(str(file_id) for file_id in file_ids)
 
 
-async def get_search_results(query: str, file_type=None, max_results=10, offset=0, recent=False):
+async def watch_changes():
+    """
+    Keep this process's search index and caches in sync with files saved or deleted by other bot
+    instances and scripts, by publishing collection changes to `change_bus` until cancelled.
+    """
+    change_bus.subscribe(saved=_saved_elsewhere, deleted=_deleted_elsewhere)
+    projection = {**INDEX_PROJECTION, "search_grams": 1}
+    await watch(database[COLLECTION_NAME], deletions, change_bus, projection, CHANGES_POLL_INTERVAL)
+
+
+def record_query(query, file_type=None, size_range=None):
+    """Count an inline query in query_log, for prewarm_queries"""
+    if PREWARM_QUERIES > 0:
+        query_log.record((normalize(query), file_type, size_range))
+
+
+def _mark_stale(doc):
+    texts = [doc.get("file_name") or ""]
+    if USE_CAPTION_FILTER:
+        texts.append(doc.get("caption") or "")
+    for key, regex in _hot.items():
+        if key not in _stale and accepts(doc, key[1], key[2]) and any(regex.search(text) for text in texts):
+            _stale.add(key)
+    if _stale and _stale_event is not None:
+        _stale_event.set()
+
+
+async def prewarm_queries(max_results=10):
+    """
+    Keep the first inline page of the PREWARM_QUERIES most frequent queries in result_cache until cancelled.
+    The counts of the previous run are loaded first, so the pages are ready as soon as the search index is
+    after a restart. Every page is searched again each PREWARM_INTERVAL seconds, before it expires, and
+    a hot query is searched again right away when a file it matches is saved.
+    """
+    global _hot, _stale_event
+    saved = await queries.find_one({"_id": "top"})
+    if saved:
+        query_log.load(((query, file_type, tuple(size_range) if size_range else None), count)
+                       for (query, file_type, size_range), count in saved["queries"])
+    _stale_event = asyncio.Event()
+    while not spelling.ready:
+        await asyncio.sleep(1)
+
+    warmed = None
+    while True:
+        if warmed is None or time.monotonic() - warmed >= PREWARM_INTERVAL:
+            warmed = time.monotonic()
+            _hot = {key: build_regex(key[0])[1] for key, _ in query_log.top(PREWARM_QUERIES)}
+            keys = list(_hot)
+            await queries.replace_one(
+                {"_id": "top"},
+                {"queries": [[list(key), count] for key, count in query_log.top(query_log.capacity)]},
+                upsert=True,
+            )
+        else:
+            keys = [key for key in _stale if key in _hot]
+        # files saved while these are searched mark their queries stale again
+        _stale.clear()
+        _stale_event.clear()
+
+        for query, file_type, size_range in keys:
+            try:
+                await cached_search(query, file_type, max_results, size_range=size_range)
+            except Exception:
+                logger.exception(f"Failed to prewarm '{query}'")
+
+        try:
+            await asyncio.wait_for(_stale_event.wait(), max(warmed + PREWARM_INTERVAL - time.monotonic(), 0))
+            # files are saved in batches, let the rest of this one land first
+            await asyncio.sleep(1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def update_facets(docs, sign=1):
+    """Add (or with sign=-1 subtract) Media documents to the materialized facet counters"""
+    requests = [
+        UpdateOne(
+            {"_id": f"{facet}:{value}"},
+            {"$inc": {"count": sign * count}, "$set": {"facet": facet, "value": value}},
+            upsert=True,
+        )
+        for (facet, value), count in count_facets(docs).items()
+    ]
+    if requests:
+        try:
+            await facets.bulk_write(requests, ordered=False)
+        except Exception:
+            logger.exception("Failed to update facet counters")
+
+
+async def rebuild_facets():
+    """Recount every facet with one aggregation and replace the materialized counters"""
+    pipeline = [{"$facet": {
+        "file_type": [{"$group": {"_id": "$file_type", "count": {"$sum": 1}}}],
+        "mime_type": [{"$group": {"_id": "$mime_type", "count": {"$sum": 1}}}],
+        "chat": [{"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}],
+        "size": [{"$bucket": {
+            "groupBy": {"$ifNull": ["$file_size", 0]},
+            "boundaries": list(SIZE_BOUNDS) + [2 ** 62],
+            "default": 0,
+        }}],
+    }}]
+    result = await database[COLLECTION_NAME].aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+    docs = []
+    for facet, groups in result[0].items():
+        for group in groups:
+            value = group["_id"]
+            if facet == "size":
+                value = SIZE_LABELS[SIZE_BOUNDS.index(value)]
+            if value is not None:
+                docs.append({"_id": f"{facet}:{value}", "facet": facet, "value": value, "count": group["count"]})
+    await facets.delete_many({})
+    if docs:
+        await facets.insert_many(docs)
+    return len(docs)
+
+
+async def get_facets(query="", file_type=None, size_range=None, limit=10000):
+    """
+    Return {facet: {value: count}} for the files matching a query.
+    Without query and filters the materialized counters answer instantly, otherwise the newest
+    `limit` matches are counted on the server through the same indexed lookup searches use.
+    """
+    if not query and not file_type and size_range is None:
+        counts = {facet: {} for facet in FACETS}
+        async for doc in facets.find({"count": {"$gt": 0}}):
+            counts.setdefault(doc["facet"], {})[doc["value"]] = doc["count"]
+        return counts
+
+    parts, regex = build_regex(query)
+    mongo_filter = _terms_filter(parts, regex, file_type, size_range) if parts else _filters(file_type, size_range)
+    projection = {"file_type": 1, "mime_type": 1, "file_size": 1, "chat_id": 1}
+    cursor = search_collection().find(mongo_filter, projection).sort("created", -1).limit(limit)
+    docs = await cursor.max_time_ms(SEARCH_TIME_LIMIT_MS).to_list(length=limit)
+    counts = {facet: {} for facet in FACETS}
+    for (facet, value), count in count_facets(docs).items():
+        counts[facet][value] = count
+    return counts
+
+
+def _filters(file_type, size_range):
+    mongo_filter = {}
+    if file_type:
+        mongo_filter["file_type"] = file_type
+    if size_range is not None:
+        mongo_filter["file_size"] = size_filter(size_range)
+    return mongo_filter
+
+
+# files newest first, then the files saved before `created` existed in _id order
+NEWEST_FIRST = [("created", -1), ("_id", 1)]
+
+
+def _key(doc):
+    """Keyset key of a Media document in NEWEST_FIRST order"""
+    return doc.get("created") or str(doc["_id"])
+
+
+def _after(key):
+    """Filter of the files after `key` in NEWEST_FIRST order"""
+    if isinstance(key, str):
+        return {"created": None, "_id": {"$gt": key}}
+    return {"$or": [{"created": {"$lt": key}}, {"created": None}]}
+
+
+def _terms_filter(parts, regex, file_type, size_range):
+    """Indexed lookup on the multikey search_grams / search_tokens fields, confirmed by the query regex"""
+    grams = set()
+    for part in parts:
+        grams.update(trigrams(part))
+    if grams:
+        mongo_filter = {"search_grams": {"$all": sorted(grams)}}
+    else:
+        mongo_filter = {"search_tokens": {"$all": [re.compile("^" + re.escape(p)) for p in parts]}}
+    if USE_CAPTION_FILTER:
+        mongo_filter["$or"] = [{"file_name": {"$regex": regex}}, {"caption": {"$regex": regex}}]
+    else:
+        mongo_filter["file_name"] = {"$regex": regex}
+    mongo_filter.update(_filters(file_type, size_range))
+    return mongo_filter
+
+
+async def ensure_indexes():
+    """
+    Create the Media indexes missing from the collection and return how many were created.
+    Media.ensure_indexes() sends a createIndex per index on every start, this is one listIndexes
+    round trip when every index is in place. The deletions log gets a TTL index, so it only keeps
+    the DELETIONS_TTL that snapshots and other bots need to catch up.
+    """
+    col = database[COLLECTION_NAME]
+    existing = await col.index_information()
+    missing = [index for index in Media.indexes if index.document["name"] not in existing]
+    for index in missing:
+        options = index.document.copy()
+        keys = list(options.pop("key").items())
+        logger.info(f"Creating index {options['name']}")
+        await col.create_index(keys, **options)
+
+    if "deleted_1" not in await deletions.index_information():
+        logger.info("Creating index deleted_1")
+        await deletions.create_index("deleted", expireAfterSeconds=int(DELETIONS_TTL.total_seconds()))
+        # deletions logged before they had a `deleted` time never expire
+        expired = ObjectId.from_datetime(datetime.now(timezone.utc) - DELETIONS_TTL)
+        await deletions.delete_many({"deleted": {"$exists": False}, "_id": {"$lt": expired}})
+        missing.append("deleted_1")
+    return len(missing)
+
+
+async def count_files(mongo_filter=None):
+    """
+    Number of saved files from collection metadata, instant even on huge collections,
+    or the number matching `mongo_filter`, which has to read them
+    """
+    if mongo_filter is None:
+        return await database[COLLECTION_NAME].estimated_document_count()
+    return await database[COLLECTION_NAME].count_documents(mongo_filter)
+
+
+async def get_checkpoint(chat_id):
+    """Return the indexing checkpoint of a chat, or None if it was never indexed"""
+    return await checkpoints.find_one({"_id": chat_id})
+
+
+async def save_checkpoint(chat_id, **fields):
+    await checkpoints.update_one({"_id": chat_id}, {"$set": fields}, upsert=True)
+
+
+def _may_match(word):
+    """Whether every trigram of `word` occurs in some saved file, so the word can match as typed"""
+    grams = trigrams(word)
+    if search_index.ready:
+        return all(search_index.has_gram(gram) for gram in grams)
+    if gram_filter is not None:
+        return all(gram in gram_filter for gram in grams)
+    return False
+
+
+def _learn_words(doc):
+    spelling.add_text(doc.get("file_name"))
+    if USE_CAPTION_FILTER:
+        spelling.add_text(doc.get("caption"))
+
+
+async def build_gram_filter():
+    """
+    Load the distinct stored search grams into `gram_filter`, so queries with a gram no file has are
+    rejected without touching MongoDB. distinct() runs on the server and only sends the few distinct grams,
+    so this is ready long before the in-memory search index. Skipped while files without search terms are left.
+    """
+    global gram_filter, _gram_backlog, _migrated
+    col = database[COLLECTION_NAME]
+    if await col.find_one({"$or": [{"search_grams": {"$exists": False}}, {"created": {"$exists": False}}]}, {"_id": 1}):
+        logger.warning("Gram filter and indexed lookups disabled until migrate_media added search terms to every file")
+        return
+    _migrated = True
+    _gram_backlog = set()
+    try:
+        grams = await col.distinct("search_grams")
+        # room for grams of files saved later, trigrams are a small closed set anyway
+        bloom = BloomFilter(2 * len(grams) + 1000)
+        bloom.update(grams)
+        bloom.update(_gram_backlog)
+        gram_filter = bloom
+    finally:
+        _gram_backlog = None
+    logger.info(f"Gram filter built with {len(grams)} grams")
+
+
+def use_search_workers(workers):
+    """Answer index pages with a started SearchWorkers pool, the bot process then keeps no index of its own"""
+    global search_workers
+    search_workers = workers
+
+
+async def _index_add(docs):
+    if search_workers is not None:
+        await search_workers.add(docs)
+    else:
+        for doc in docs:
+            search_index.add(doc)
+
+
+async def _index_remove(file_ids):
+    if search_workers is not None:
+        await search_workers.remove(file_ids)
+    else:
+        for file_id in file_ids:
+            search_index.remove(file_id)
+
+
+async def build_search_index():
+    """
+    Load every Media document into the in-memory search index and the typo correction vocabulary.
+    With an INDEX_SNAPSHOT file both start from the snapshot and only files saved or deleted since it was
+    written are read from MongoDB. With search workers only the vocabulary is built here,
+    every worker loads its own index.
+    """
+    started = time.monotonic()
+    local = search_workers is None
+    snapshot = open_snapshot(INDEX_SNAPSHOT, USE_CAPTION_FILTER)
+    removed_filter, mongo_filter = catch_up_filters(snapshot)
+    if snapshot is not None:
+        for word, count in snapshot.vocabulary():
+            spelling.add_word(word, count)
+        if local:
+            search_index.load(snapshot)
+            async for deletion in deletions.find(removed_filter):
+                search_index.remove(deletion["file_id"])
+
+    projection = INDEX_PROJECTION if local else {"file_name": 1, "caption": 1}
+    cursor = database[COLLECTION_NAME].find(mongo_filter, projection).sort("created", 1).batch_size(5000)
+    read = 0
+    async for doc in cursor:
+        if local:
+            search_index.add(doc)
+        _learn_words(doc)
+        read += 1
+    spelling.finish()
+    source = f"snapshot of {snapshot.count} files and {read} newer" if snapshot else f"{read}"
+    if local:
+        search_index.ready = True
+        logger.info(f"Search index built from {source} files in {time.monotonic() - started:.1f}s, "
+                    f"{len(search_index)} files and {len(spelling)} words")
+    else:
+        logger.info(f"Spelling vocabulary built from {source} files with {len(spelling)} words")
+
+
+async def save_search_snapshot():
+    """
+    Write the search index and spelling vocabulary to INDEX_SNAPSHOT for the next start.
+    The index is copied on the event loop and encoded in a thread, or written by a search worker.
+    Returns the number of files written, None while the index is still being built.
+    """
+    if not spelling.ready:
+        return None
+    started = time.monotonic()
+    taken = ObjectId()
+    words = dict(spelling.counts)
+    if search_workers is not None:
+        count = await search_workers.snapshot(INDEX_SNAPSHOT, words, taken)
+    elif search_index.ready:
+        docs, postings, watermark = search_index.export()
+        count = await asyncio.get_event_loop().run_in_executor(
+            None, write_snapshot, INDEX_SNAPSHOT, docs, postings, words, watermark, taken, USE_CAPTION_FILTER,
+        )
+    else:
+        return None
+    if count is not None:
+        logger.info(f"Search index snapshot of {count} files written in {time.monotonic() - started:.1f}s")
+    return count
+
+
+async def migrate_media(batch_size=1000, progress=None):
+    """
+    Backfill search_tokens/search_grams and created on documents saved before they existed,
+    then enable the indexed lookup they need.
+    Only documents still missing them are read, so an interrupted run resumes where it stopped.
+    Backfilled `created` values count down from the oldest one in the collection while documents are
+    visited newest first in insertion order, so legacy files stay older than every file saved since and
+    keep their order, and an interrupted run carries on below the ones it already gave out.
+    `progress` is awaited with the number of documents updated so far after every batch.
+    """
+    col = database[COLLECTION_NAME]
+    pending = {"$or": [{"search_grams": {"$exists": False}}, {"created": {"$exists": False}}]}
+    projection = {"file_name": 1, "caption": 1, "created": 1}
+    oldest = await col.find_one({"created": {"$exists": True}}, {"created": 1}, sort=[("created", 1)])
+    created = int.from_bytes((oldest["created"] if oldest else ObjectId()).binary, "big")
+    done = 0
+    requests = []
+
+    async def flush():
+        nonlocal done
+        await col.bulk_write(requests, ordered=False)
+        done += len(requests)
+        requests.clear()
+        if progress is not None:
+            await progress(done)
+
+    global _migrated
+    async for doc in col.find(pending, projection).sort("$natural", -1).batch_size(batch_size):
+        tokens, grams = search_terms(doc.get("file_name"), doc.get("caption") if USE_CAPTION_FILTER else None)
+        update = {"search_tokens": tokens, "search_grams": grams}
+        if "created" not in doc:
+            created -= 1
+            update["created"] = ObjectId(created.to_bytes(12, "big"))
+        requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+        if len(requests) >= batch_size:
+            await flush()
+
+    if requests:
+        await flush()
+    _migrated = True
+    return done
+
+
+async def dedupe_media(batch_size=1000, progress=None):
+    """
+    Remove files saved more than once under different file_ids, keeping the oldest copy,
+    then store the fingerprint of files saved before it existed, so the unique index covers them too.
+    Only files sharing size and mime type are compared, grouped on the server.
+    `progress` is awaited with the number of documents removed so far after every batch.
+    Returns (removed, fingerprinted).
+    """
+    col = database[COLLECTION_NAME]
+    pipeline = [
+        {"$project": {
+            "file_name": 1, "file_size": 1, "file_type": 1, "mime_type": 1, "chat_id": 1, "fingerprint": 1, "created": 1,
+        }},
+        {"$group": {
+            "_id": {"size": "$file_size", "mime": "$mime_type"},
+            "count": {"$sum": 1},
+            "docs": {"$push": "$$ROOT"},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    oldest = ObjectId(b"\x00" * 12)
+    removed = 0
+    doomed = []
+
+    async def flush():
+        nonlocal removed
+        await col.delete_many({"_id": {"$in": [doc["_id"] for doc in doomed]}})
+        await _forget(doomed)
+        removed += len(doomed)
+        doomed.clear()
+        if progress is not None:
+            await progress(removed)
+
+    async for group in col.aggregate(pipeline, allowDiskUse=True):
+        kept = []
+        for doc in sorted(group["docs"], key=lambda d: d.get("created") or oldest):
+            if any(same_file(doc, other, DUPLICATE_DISTANCE) for other in kept):
+                doomed.append(doc)
+            else:
+                kept.append(doc)
+        if len(doomed) >= batch_size:
+            await flush()
+    if doomed:
+        await flush()
+
+    fingerprinted = 0
+    requests = []
+    projection = {"file_name": 1, "file_size": 1, "mime_type": 1}
+    async for doc in col.find({"fingerprint": {"$exists": False}}, projection).batch_size(batch_size):
+        value = fingerprint(doc.get("file_name"), doc.get("file_size"), doc.get("mime_type"))
+        requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"fingerprint": value}}))
+        if len(requests) >= batch_size:
+            fingerprinted += await _write_fingerprints(col, requests)
+    if requests:
+        fingerprinted += await _write_fingerprints(col, requests)
+    return removed, fingerprinted
+
+
+async def _write_fingerprints(col, requests):
+    """Apply and clear fingerprint updates, files saved concurrently with the same fingerprint are left for next run"""
+    try:
+        result = await col.bulk_write(requests, ordered=False)
+        count = result.modified_count
+    except BulkWriteError as e:
+        count = e.details.get("nModified", 0)
+        logger.warning(f"{len(e.details.get('writeErrors', []))} files got a duplicate while dedupe was running")
+    requests.clear()
+    return count
+
+
+async def export_media(path, since=None, progress=None):
+    """
+    Write saved files to a compressed export file, see transfer.export_documents.
+    With `since`, the watermark returned by a previous export, only files saved after it are written,
+    along with those stamped WATERMARK_MARGIN before it that may have been inserted after that export.
+    Importing overlapping exports skips the files saved twice. Returns (number of files, watermark).
+    """
+    mongo_filter = {}
+    if since is not None:
+        mongo_filter = {"created": {"$gt": ObjectId.from_datetime(since.generation_time - WATERMARK_MARGIN)}}
+    return await export_documents(database[COLLECTION_NAME], path, mongo_filter, progress=progress)
+
+
+async def import_media(path, batch_size=1000, parallel=4, progress=None):
+    """
+    Insert the files of an export file, skipping those already saved, then create the missing
+    indexes and recount facets. Indexes are built once after the documents when the collection
+    didn't have them, which is faster than updating them on every insert.
+    Returns (inserted, skipped).
+    """
+    inserted, skipped = await import_documents(database[COLLECTION_NAME], path, batch_size, parallel, progress)
+    await ensure_indexes()
+    if inserted:
+        await rebuild_facets()
+    return inserted, skipped
+
+
+async def get_search_results(query: str, file_type=None, max_results=10, offset="", recent=False, size_range=None):
     """
     Adaptive, batch-based search:
+    - If the in-memory search index is built -> answer from its posting lists.
     - If recent or empty -> return recent files fast.
+    - Otherwise -> indexed $all lookup on the stored search_grams (search_tokens prefix for 1-2 letter words).
+    - Index and indexed lookup results are ranked by relevance among the newest RANK_CANDIDATES matches.
     - If query length >= 3 -> try server-side regex but iterate cursor in batches and stop early.
     - If server-side fails or query short -> fallback to client-side batch scan (small batches) until enough results.
+    Pages are keyset based: `offset` is the opaque token returned as next_offset by the previous page.
+    `size_range` is an inclusive (min, max) file_size pair from facets.parse_query, None bounds are open.
     Returns (normalized_list, next_offset)
     """
+    trace = current_trace.get()
+    token = None
+    if trace is None:
+        trace = SearchTrace()
+        token = current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        return await _search_results(query, file_type, max_results, offset, recent, size_range)
+    finally:
+        search_latency.observe((time.perf_counter() - started) * 1000, label=trace.stage)
+        search_scanned.observe(trace.scanned, label=trace.stage)
+        if token is not None:
+            current_trace.reset(token)
+
+
+async def cached_search(query, file_type=None, max_results=10, offset="", size_range=None):
+    """get_search_results stored in result_cache, with whether the page holds every match for prefix reuse"""
+    trace = SearchTrace()
+    token = current_trace.set(trace)
+    try:
+        result = await get_search_results(query, file_type, max_results, offset, size_range=size_range)
+    finally:
+        current_trace.reset(token)
+    result_cache.store(query, (file_type, size_range), offset, max_results, result, complete=trace.complete)
+    return result
+
+
+def search_collection():
+    """Media collection for search reads, which may go to secondaries, writes always use the primary"""
+    return database.get_collection(COLLECTION_NAME, read_preference=search_read_preference)
+
+
+async def _search_results(query, file_type, max_results, offset, recent, size_range):
     q = (query or "").strip()
-    projection = {"file_name": 1, "file_size": 1, "file_type": 1, "caption": 1, "_id": 1}
-    col = database[COLLECTION_NAME]
+    corrected = None
+    if q and not recent:
+        # misspelled words are fixed up front, they would otherwise fall through to the slowest stages
+        corrected = spelling.correct(q, _may_match)
+        if corrected:
+            logger.info(f"Corrected '{q}' to '{corrected}'")
+            q = corrected
+
+    def _complete():
+        # pages are cached under the query as typed, a corrected page can't be filtered for longer typed queries
+        if not corrected:
+            record_complete()
+
+    projection = {"file_name": 1, "file_size": 1, "file_type": 1, "caption": 1, "created": 1, "_id": 1}
+    col = search_collection()
+    # every query gets SEARCH_TIME_LIMIT_MS on the server, a timed out stage falls through to a cheaper one
+    time_limit = SEARCH_TIME_LIMIT_MS
+    timed_out = False
+    parts, smart_regex = build_regex(q)
+    query_key = query_fingerprint(" ".join(parts) or q, file_type, recent or not q, size_range)
+    after = decode_offset(offset, query_key)
+    grams = set()
+    for part in parts:
+        grams.update(trigrams(part))
+
+    if grams and not recent:
+        if gram_filter is not None and not all(gram in gram_filter for gram in grams):
+            record_search("bloom")
+            _complete()
+            return [], ""
+        if negative_cache.contains(q, file_type, size_range):
+            record_search("negative")
+            _complete()
+            return [], ""
 
     def _normalize(docs):
         out = []
@@ -82,104 +940,200 @@ async def get_search_results(query: str, file_type=None, max_results=10, offset=
             })
         return out
 
+    def _page(docs):
+        normalized = _normalize(docs)
+        if len(docs) < max_results:
+            return normalized, ""
+        try:
+            return normalized, encode_offset(query_key, _key(docs[-1]))
+        except ValueError:
+            # an _id too long for Telegram's offsets, only files saved by old versions have those
+            return normalized, ""
+
+    def _keyset(mongo_filter):
+        if after is None:
+            return mongo_filter
+        return {"$and": [mongo_filter, _after(after)]} if mongo_filter else _after(after)
+
+    # queries are ranked by relevance over the newest RANK_CANDIDATES matches, offsets carry (score, key)
+    ranked = RANK_CANDIDATES > 0 and bool(parts) and not recent
+    # ranked queries the indexed stages couldn't answer were paged by the regex or fallback stage, on `created`
+    scanning = ranked and isinstance(after, (ObjectId, str))
+    if isinstance(after, tuple) != ranked and not scanning:
+        after = None
+
+    def _ranked_page(candidates):
+        best = rank(candidates, parts, max_results, after, USE_CAPTION_FILTER)
+        next_offset = encode_offset(query_key, best[-1][:2]) if len(best) == max_results else ""
+        return [doc for _, _, doc in best], next_offset
+
+    # 0) in-memory index (or search worker processes) -> posting list intersection, newest first
+    use_workers = search_workers is not None and search_workers.ready
+    if (use_workers or search_index.ready) and (recent or not q or parts) and key_source(after) != "mongo":
+        args = ("" if recent else q, file_type, max_results, after, ranked, size_range, RANK_CANDIDATES)
+        page = await search_workers.page(*args) if use_workers else index_page(search_index, *args)
+        if page is not None:
+            docs, next_key, scanned, complete = page
+            record_search("index", scanned)
+            if complete:
+                _complete()
+            return docs, encode_offset(query_key, next_key) if next_key is not None else ""
+
+    if key_source(after) == "index":
+        # the previous page came from the in-memory index, which is not available anymore: the database
+        # can't continue where it stopped, and starting over would show the first page again
+        return [], ""
+
     # 1) recent / empty query -> recent results fast
     if recent or not q:
-        cursor = col.find({}, projection).sort("$natural", -1).skip(offset).limit(max_results)
+        mongo_filter = _keyset(_filters(file_type, size_range))
+        cursor = col.find(mongo_filter, projection).sort(NEWEST_FIRST).limit(max_results).max_time_ms(time_limit)
         docs = await cursor.to_list(length=max_results)
-        normalized = _normalize(docs)
-        next_offset = "" if len(normalized) < max_results else offset + max_results
-        return normalized, next_offset
-
-    # prepare smart regex pattern (super flexible)
-    safe_query = re.sub(r"[^0-9a-zA-Z\u00C0-\u024F]+", " ", q).strip()
-    pattern_parts = [re.escape(p) for p in safe_query.split() if p]
-    if not pattern_parts:
-        # fallback to substring
-        pattern = re.escape(q)
-    else:
-        pattern = ".*".join(pattern_parts)
-    smart_regex = re.compile(pattern, re.IGNORECASE)
-
-    # if file_type filter provided, include it
-    file_type_filter = {"file_type": file_type} if file_type else {}
+        record_search("recent", len(docs))
+        return _page(docs)
 
-    # 2) Try server-side regex but iterate in batches and stop early
-    try:
-        # If query is short (len < 3) server might scan too much — we will still try but with cautious batch size
-        batch_size = 50 if len(q) >= 3 else 30
-
-        mongo_filter = {"file_name": {"$regex": smart_regex}}
-        if USE_CAPTION_FILTER:
-            mongo_filter = {"$or": [{"file_name": {"$regex": smart_regex}}, {"caption": {"$regex": smart_regex}}]}
-
-        if file_type:
-            # add file_type constraint
-            if "$or" in mongo_filter:
-                for clause in mongo_filter["$or"]:
-                    clause.update({"file_type": file_type})
+    # 2) indexed lookup on the multikey search_grams / search_tokens fields, which files saved before they
+    # existed don't have, so until migrate_media ran every query goes to the regex stage
+    if parts and not scanning and _migrated:
+        terms_filter = _terms_filter(parts, smart_regex, file_type, size_range)
+        try:
+            if ranked:
+                cursor = col.find(terms_filter, projection).sort("created", -1).limit(RANK_CANDIDATES).max_time_ms(time_limit)
+                # documents saved before `created` existed have no stable key, /migrate gives them one
+                docs = [doc for doc in await cursor.to_list(length=RANK_CANDIDATES) if doc.get("created")]
+                candidates = list(zip((doc["created"] for doc in docs), _normalize(docs)))
+                record_search("indexed", len(docs))
+                if candidates or after is not None:
+                    logger.info(f"Indexed lookup ranked {len(candidates)} candidates for '{q}'")
+                    files, next_offset = _ranked_page(candidates)
+                    # the gram filter is only built once every file has search terms this lookup can find
+                    if not next_offset and len(docs) < RANK_CANDIDATES and gram_filter is not None:
+                        _complete()
+                    return files, next_offset
             else:
-                mongo_filter["file_type"] = file_type
-
-        cursor = col.find(mongo_filter, projection).sort("$natural", -1).batch_size(batch_size)
-        collected = []
-        collected_needed = offset + max_results
-
-        # iterate cursor and stop when enough matches collected
-        while await cursor.fetch_next:
-            doc = cursor.next_object()
-            collected.append(doc)
-            if len(collected) >= collected_needed:
-                break
-
-        # If collected less than needed, we still return what we have
-        sliced = collected[offset: offset + max_results]
-        if sliced:
-            normalized = _normalize(sliced)
-            next_offset = "" if len(sliced) < max_results else offset + max_results
-            logger.info(f"Server-regex matched {len(normalized)} for '{q}' (iterative)")
-            return normalized, next_offset
-        # else fallthrough to client-side fallback
-    except Exception as e:
-        logger.warning(f"Server-side regex failed/slow for '{q}': {e}")
-
-    # 3) Client-side fallback scan in small batches (safe)
+                cursor = col.find(_keyset(terms_filter), projection).sort("created", -1).limit(max_results)
+                cursor = cursor.max_time_ms(time_limit)
+                docs = await cursor.to_list(length=max_results)
+                record_search("indexed", len(docs))
+                if docs:
+                    logger.info(f"Indexed lookup matched {len(docs)} for '{q}'")
+                    if len(docs) < max_results and gram_filter is not None:
+                        _complete()
+                    return _page(docs)
+        except ExecutionTimeout:
+            timed_out = True
+            record_search("timeout")
+            logger.warning(f"Indexed lookup for '{q}' exceeded {time_limit} ms")
+        except Exception as e:
+            logger.warning(f"Indexed lookup failed for '{q}': {e}")
+
+    if isinstance(after, tuple):
+        # continuation of ranked results that can't be served anymore
+        return [], ""
+
+    # 3) and 4) read the collection itself, at most EXPENSIVE_SEARCHES at a time so they can't starve cheap ones
+    if not expensive_searches.try_acquire():
+        record_search("shed")
+        raise Overloaded(f"{expensive_searches.limit} expensive searches are running already")
+    # whether a stage below looked at every file, so finding fewer than max_results means there are no more
+    exhaustive = False
     try:
-        # For short queries, scan fewer docs per batch to keep fast; longer queries can scan more
-        batch_doc_limit = 200 if len(q) >= 5 else 120
-        scanned = 0
-        matched = []
-        # We'll fetch in pages of page_size (to avoid loading huge lists)
-        page_size = 200
-        page = 0
-        q_lower = q.lower()
-
-        while len(matched) < (offset + max_results):
-            docs = await col.find({}, projection).sort("$natural", -1).skip(page * page_size).limit(page_size).to_list(length=page_size)
-            if not docs:
-                break
-            for d in docs:
-                name = (d.get("file_name") or "").lower()
-                caption = (d.get("caption") or "").lower()
-                # match using smart_regex first (fast in Python) or substring
-                if smart_regex.search(name) or (USE_CAPTION_FILTER and smart_regex.search(caption)) or (q_lower in name) or (USE_CAPTION_FILTER and q_lower in caption):
-                    matched.append(d)
-                    if len(matched) >= (offset + max_results):
+        # 3) Try server-side regex but iterate in batches and stop early
+        # skipped when the indexed lookup already timed out, the regex would scan even more
+        if not timed_out:
+            try:
+                # If query is short (len < 3) server might scan too much — we will still try but with cautious batch size
+                batch_size = 50 if len(q) >= 3 else 30
+
+                mongo_filter = {"file_name": {"$regex": smart_regex}}
+                if USE_CAPTION_FILTER:
+                    mongo_filter = {"$or": [{"file_name": {"$regex": smart_regex}}, {"caption": {"$regex": smart_regex}}]}
+
+                # add file_type / size constraints
+                if "$or" in mongo_filter:
+                    for clause in mongo_filter["$or"]:
+                        clause.update(_filters(file_type, size_range))
+                else:
+                    mongo_filter.update(_filters(file_type, size_range))
+
+                cursor = col.find(_keyset(mongo_filter), projection).sort(NEWEST_FIRST).batch_size(batch_size)
+                cursor = cursor.max_time_ms(time_limit)
+                collected = []
+
+                # iterate cursor and stop when a page is collected, the keyset filter already skips previous pages
+                async for doc in cursor:
+                    collected.append(doc)
+                    if len(collected) >= max_results:
                         break
-            scanned += len(docs)
-            page += 1
-            # safety: don't scan indefinitely - cap scanned docs
-            if scanned >= (batch_doc_limit * 5):  # hard cap ~ batch_doc_limit*5 docs
-                break
-
-        sliced = matched[offset: offset + max_results]
-        if sliced:
-            normalized = _normalize(sliced)
-            next_offset = "" if len(sliced) < max_results else offset + max_results
-            logger.info(f"Client-fallback matched {len(normalized)} for '{q}' after scanning {scanned} docs")
-            return normalized, next_offset
-
-    except Exception as e:
-        logger.error(f"Client-side fallback error for '{q}': {e}")
-
-    # 4) nothing found
+
+                # If collected less than needed, we still return what we have
+                record_search("regex", len(collected))
+                exhaustive = len(collected) < max_results
+                if collected:
+                    logger.info(f"Server-regex matched {len(collected)} for '{q}' (iterative)")
+                    if exhaustive:
+                        _complete()
+                    return _page(collected)
+                # else fallthrough to client-side fallback
+            except ExecutionTimeout as e:
+                timed_out = True
+                record_search("timeout")
+                logger.warning(f"Server-side regex for '{q}' cancelled after {time_limit} ms: {e}")
+            except Exception as e:
+                logger.warning(f"Server-side regex failed/slow for '{q}': {e}")
+
+        # 4) Client-side fallback scan in small batches (safe)
+        try:
+            # For short queries, scan fewer docs per batch to keep fast; longer queries can scan more
+            batch_doc_limit = 200 if len(q) >= 5 else 120
+            scanned = 0
+            matched = []
+            # We'll fetch in pages of page_size (to avoid loading huge lists), resuming after the last doc seen
+            page_size = 200
+            last_seen = after
+            # its substring matching finds more than the regex, which may have looked at every file
+            exhaustive = False
+            q_lower = q.lower()
+
+            while len(matched) < max_results:
+                page_filter = _after(last_seen) if last_seen is not None else {}
+                cursor = col.find(page_filter, projection).sort(NEWEST_FIRST).limit(page_size).max_time_ms(time_limit)
+                docs = await cursor.to_list(length=page_size)
+                if not docs:
+                    exhaustive = True
+                    break
+                for d in docs:
+                    name = (d.get("file_name") or "").lower()
+                    caption = (d.get("caption") or "").lower()
+                    # match using smart_regex first (fast in Python) or substring
+                    if smart_regex.search(name) or (USE_CAPTION_FILTER and smart_regex.search(caption)) or (q_lower in name) or (USE_CAPTION_FILTER and q_lower in caption):
+                        if accepts(d, file_type, size_range):
+                            matched.append(d)
+                            if len(matched) >= max_results:
+                                break
+                scanned += len(docs)
+                record_search("fallback", len(docs))
+                last_seen = _key(docs[-1])
+                # safety: don't scan indefinitely - cap scanned docs
+                if scanned >= (batch_doc_limit * 5):  # hard cap ~ batch_doc_limit*5 docs
+                    break
+
+            if matched:
+                logger.info(f"Client-fallback matched {len(matched)} for '{q}' after scanning {scanned} docs")
+                if exhaustive:
+                    _complete()
+                return _page(matched)
+
+        except Exception as e:
+            logger.error(f"Client-side fallback error for '{q}': {e}")
+    finally:
+        expensive_searches.release()
+
+    # 5) nothing found
+    record_search("none")
+    if exhaustive:
+        _complete()
+        # only a stage that looked at every file proves there is no match, not one that gave up scanning
+        if after is None:
+            negative_cache.add(q, file_type, size_range)
     return [], ""
@@ -0,0 +1,76 @@
+import re
+from functools import lru_cache
+from hashlib import blake2b
+
+from .search_index import normalize, trigrams
+
+_sign = 1 << 63
+# channel mentions and links added by whoever re-uploaded a file
+_tags = re.compile(r"@\w+|(?:https?://)?t\.me/\S*", re.IGNORECASE)
+_numbers = re.compile(r"\d+")
+
+
+def _int64(value):
+    """Fold an unsigned 64 bit value into the signed range BSON can store"""
+    return value - (1 << 64) if value >= _sign else value
+
+
+@lru_cache(maxsize=65536)
+def _feature_hash(feature):
+    return format(int.from_bytes(blake2b(feature.encode(), digest_size=8).digest(), "big"), "064b")
+
+
+def _clean(file_name):
+    return normalize(_tags.sub(" ", file_name or ""))
+
+
+def fingerprint(file_name, file_size, mime_type):
+    """64 bit content fingerprint, equal for the same file re-uploaded under a differently punctuated or tagged name"""
+    key = f"{_clean(file_name)}\x1f{file_size}\x1f{mime_type or ''}"
+    return _int64(int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big"))
+
+
+@lru_cache(maxsize=4096)
+def simhash(file_name):
+    """
+    64 bit SimHash of the trigrams of a normalized file name.
+    Names that share most trigrams (an added channel tag, a reordered word) differ in a few bits only.
+    """
+    grams = trigrams(_clean(file_name))
+    if not grams:
+        return 0
+    half = len(grams) / 2
+    # column i of the zipped bit strings holds bit 63 - i of every feature hash
+    columns = zip(*(_feature_hash(gram) for gram in grams))
+    return _int64(int("".join("1" if column.count("1") > half else "0" for column in columns), 2))
+
+
+def distance(a, b):
+    """Number of different bits of two SimHashes"""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def _fingerprint_of(doc):
+    value = doc.get("fingerprint")
+    if value is None:
+        value = fingerprint(doc.get("file_name"), doc.get("file_size"), doc.get("mime_type"))
+    return value
+
+
+@lru_cache(maxsize=4096)
+def numbers(file_name):
+    """Numbers of a normalized file name in order, they tell volumes, parts and episodes apart"""
+    return tuple(_numbers.findall(_clean(file_name)))
+
+
+def same_file(a, b, max_distance):
+    """
+    Whether two Media documents of the same size and mime type hold the same file:
+    equal fingerprints, or names at most `max_distance` SimHash bits apart (0 disables that check)
+    that have the same numbers, so split archive volumes like .part01.rar and .part02.rar never match.
+    """
+    if _fingerprint_of(a) == _fingerprint_of(b):
+        return True
+    if max_distance <= 0 or numbers(a.get("file_name")) != numbers(b.get("file_name")):
+        return False
+    return distance(simhash(a.get("file_name")), simhash(b.get("file_name"))) <= max_distance
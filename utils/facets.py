@@ -0,0 +1,91 @@
+import re
+from bisect import bisect_right
+from collections import Counter
+
+FILE_TYPES = ("document", "video", "audio")
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+# lower bounds of the size facet buckets
+SIZE_BOUNDS = (0, 100 * MB, 500 * MB, GB, 2 * GB, 4 * GB)
+SIZE_LABELS = ("<100MB", "100MB-500MB", "500MB-1GB", "1GB-2GB", "2GB-4GB", ">4GB")
+FACETS = ("file_type", "mime_type", "size", "chat")
+
+_units = {"b": 1, "kb": 1024, "mb": MB, "gb": GB, "tb": 1024 ** 4}
+_size_filter = re.compile(r"(?<!\S)([<>]=?)\s*(\d+(?:\.\d+)?)\s*(tb|gb|mb|kb|b)(?!\S)", re.IGNORECASE)
+
+
+def size_bucket(size):
+    return SIZE_LABELS[max(bisect_right(SIZE_BOUNDS, size or 0) - 1, 0)]
+
+
+def parse_query(text):
+    """
+    Split an inline query into (query, file_type, size_range).
+    The file type goes on either side of a `|` ("avatar | video" or "video | avatar"),
+    sizes are comparisons like ">1GB" or "<=700mb" anywhere in the query.
+    size_range is an inclusive (min, max) pair in bytes with None for no bound, or None without size filters.
+    """
+    file_type = None
+    if "|" in text:
+        left, right = (side.strip() for side in text.split("|", maxsplit=1))
+        if left.lower() in FILE_TYPES and right.lower() not in FILE_TYPES:
+            text, file_type = right, left.lower()
+        else:
+            text, file_type = left, right.lower() or None
+
+    low = high = None
+    for op, number, unit in _size_filter.findall(text):
+        value = int(float(number) * _units[unit.lower()])
+        if op == ">":
+            low = max(low or 0, value + 1)
+        elif op == ">=":
+            low = max(low or 0, value)
+        elif op == "<":
+            high = value - 1 if high is None else min(high, value - 1)
+        else:
+            high = value if high is None else min(high, value)
+    text = " ".join(_size_filter.sub(" ", text).split())
+    size_range = (low, high) if low is not None or high is not None else None
+    return text, file_type, size_range
+
+
+def accepts(doc, file_type=None, size_range=None):
+    """Whether a Media document passes the file type and size filters"""
+    if file_type and doc.get("file_type") != file_type:
+        return False
+    if size_range is not None:
+        size = doc.get("file_size") or 0
+        low, high = size_range
+        if (low is not None and size < low) or (high is not None and size > high):
+            return False
+    return True
+
+
+def size_filter(size_range):
+    """MongoDB condition on file_size for a size_range"""
+    condition = {}
+    if size_range[0] is not None:
+        condition["$gte"] = size_range[0]
+    if size_range[1] is not None:
+        condition["$lte"] = size_range[1]
+    return condition
+
+
+def facet_values(doc):
+    """(facet, value) pairs a Media document is counted under"""
+    values = [
+        ("file_type", doc.get("file_type")),
+        ("mime_type", doc.get("mime_type")),
+        ("size", size_bucket(doc.get("file_size"))),
+        ("chat", doc.get("chat_id")),
+    ]
+    return [(facet, value) for facet, value in values if value is not None]
+
+
+def count_facets(docs):
+    """Counter of (facet, value) over Media documents"""
+    counts = Counter()
+    for doc in docs:
+        counts.update(facet_values(doc))
+    return counts
@@ -1,11 +1,15 @@
 from typing import Union
 
+import re
+import time
 import base64
-from struct import pack
+from struct import pack, unpack_from, error as struct_error
 
 from pyrogram import raw
 from pyrogram.file_id import FileId, FileType, PHOTO_TYPES, DOCUMENT_TYPES
 
+_document_types = frozenset(int(file_type) for file_type in DOCUMENT_TYPES)
+
 
 def get_input_file_from_file_id(
     file_id: str,
@@ -44,20 +48,16 @@ def get_input_file_from_file_id(
     raise ValueError(f"Unknown file id: {file_id}")
 
 
-def encode_file_id(s: bytes) -> str:
-    r = b""
-    n = 0
+# RLE used by file ids: every run of zero bytes becomes b"\x00" + run length
+_zero_runs = re.compile(b"\x00+")
+_encoded_zero_runs = re.compile(b"\x00(.)", re.DOTALL)
 
-    for i in s + bytes([22]) + bytes([4]):
-        if i == 0:
-            n += 1
-        else:
-            if n:
-                r += b"\x00" + bytes([n])
-                n = 0
+WEB_LOCATION_FLAG = 1 << 24
+FILE_REFERENCE_FLAG = 1 << 25
 
-            r += bytes([i])
 
+def encode_file_id(s: bytes) -> str:
+    r = _zero_runs.sub(lambda m: b"\x00" + bytes([len(m.group())]), s + bytes([22]) + bytes([4]))
     return base64.urlsafe_b64encode(r).decode().rstrip("=")
 
 
@@ -65,17 +65,91 @@ def encode_file_ref(file_ref: bytes) -> str:
     return base64.urlsafe_b64encode(file_ref).decode().rstrip("=")
 
 
+def _read_tl_bytes(data, pos):
+    """Read TL serialized bytes at `pos`, return (value, next position)"""
+    length = data[pos]
+    if length <= 253:
+        start = pos + 1
+        padding = -(length + 1) % 4
+    else:
+        length = int.from_bytes(data[pos + 1:pos + 4], "little")
+        start = pos + 4
+        padding = -length % 4
+    end = start + length
+    return data[start:end], end + padding
+
+
+def _decode_document_file_id(file_id):
+    """
+    Return (file_type, dc_id, media_id, access_hash, file_reference) of a document file id,
+    or None for anything the full FileId.decode has to handle.
+    """
+    raw = base64.urlsafe_b64decode(file_id + "=" * (-len(file_id) % 4))
+    decoded = _encoded_zero_runs.sub(lambda m: b"\x00" * m.group(1)[0], raw)
+    end = len(decoded) - (1 if decoded[-1] < 4 else 2)
+
+    file_type, dc_id = unpack_from("<ii", decoded)
+    if file_type & WEB_LOCATION_FLAG:
+        return None
+    has_file_reference = file_type & FILE_REFERENCE_FLAG
+    file_type &= ~FILE_REFERENCE_FLAG
+    if file_type not in _document_types:
+        return None
+
+    pos = 8
+    file_reference = b""
+    if has_file_reference:
+        file_reference, pos = _read_tl_bytes(decoded, pos)
+    if pos + 16 > end:
+        return None
+    media_id, access_hash = unpack_from("<qq", decoded, pos)
+    return file_type, dc_id, media_id, access_hash, file_reference
+
+
 def unpack_new_file_id(new_file_id):
     """Return file_id, file_ref"""
-    decoded = FileId.decode(new_file_id)
-    file_id = encode_file_id(
-        pack(
-            "<iiqq",
-            int(decoded.file_type),
-            decoded.dc_id,
-            decoded.media_id,
-            decoded.access_hash,
-        )
-    )
-    file_ref = encode_file_ref(decoded.file_reference)
+    try:
+        fields = _decode_document_file_id(new_file_id)
+    except (ValueError, IndexError, struct_error):
+        fields = None
+
+    if fields is None:
+        decoded = FileId.decode(new_file_id)
+        fields = (int(decoded.file_type), decoded.dc_id, decoded.media_id, decoded.access_hash,
+                  decoded.file_reference)
+
+    file_type, dc_id, media_id, access_hash, file_reference = fields
+    file_id = encode_file_id(pack("<iiqq", file_type, dc_id, media_id, access_hash))
+    file_ref = encode_file_ref(file_reference)
     return file_id, file_ref
+
+
+def get_media(message):
+    """Return the document, video or audio of a message with file_type, caption and chat_id set, or None"""
+    for file_type in ("document", "video", "audio"):
+        media = getattr(message, file_type, None)
+        if media is not None:
+            break
+    else:
+        return None
+
+    media.file_type = file_type
+    media.caption = message.caption
+    media.chat_id = message.chat.id if message.chat else None
+    return media
+
+
+def throttled_progress(msg, template, interval=10):
+    """
+    Progress callback for long admin commands: edits `msg` to `template` formatted with the count
+    it is awaited with, at most once every `interval` seconds so Telegram doesn't rate limit the edits.
+    """
+    last_edit = time.monotonic()
+
+    async def progress(done):
+        nonlocal last_edit
+        if time.monotonic() - last_edit >= interval:
+            last_edit = time.monotonic()
+            await msg.edit(template.format(done))
+
+    return progress
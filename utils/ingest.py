@@ -0,0 +1,279 @@
+import time
+import asyncio
+import logging
+
+from info import WRITE_BUFFER_SIZE, WRITE_BUFFER_DELAY
+from .helpers import get_media
+from .metrics import flush_latency
+from .database import media_document, insert_documents, get_checkpoint, save_checkpoint
+
+logger = logging.getLogger(__name__)
+
+# get_messages accepts at most 200 ids per request
+FETCH_CHUNK = 200
+# messages per GetHistory request
+HISTORY_CHUNK = 100
+
+
+class Ingester:
+    """
+    Pipelined bulk indexing of one chat:
+    message ids -> get_messages in chunks -> Media documents -> unordered insert_many batches.
+    Stages are connected by bounded queues, so a slow stage holds back the ones before it.
+    """
+
+    def __init__(self, bot, scheduler, batch_size=500, queue_size=4):
+        self.bot = bot
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.checked = 0
+        self.files = 0
+        self.saved = 0
+
+    @property
+    def duplicates(self):
+        return self.files - self.saved
+
+    async def run(self, chat, message_ids, on_progress=None):
+        """
+        Index every message of `chat` whose id is yielded by the async iterator `message_ids`.
+        `on_progress` is awaited with the lowest message id handled so far, once its files are written.
+        """
+        chunks = asyncio.Queue(self.queue_size)
+        messages = asyncio.Queue(self.queue_size)
+        batches = asyncio.Queue(self.queue_size)
+
+        tasks = [
+            asyncio.ensure_future(self._chunk(message_ids, chunks)),
+            asyncio.ensure_future(self._fetch(chat, chunks, messages)),
+            asyncio.ensure_future(self._normalize(messages, batches)),
+            asyncio.ensure_future(self._write(batches, on_progress)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _chunk(self, message_ids, out):
+        chunk = []
+        async for message_id in message_ids:
+            chunk.append(message_id)
+            if len(chunk) >= FETCH_CHUNK:
+                await out.put(chunk)
+                chunk = []
+        if chunk:
+            await out.put(chunk)
+        await out.put(None)
+
+    async def _fetch(self, chat, inp, out):
+        while True:
+            chunk = await inp.get()
+            if chunk is None:
+                break
+            messages = await self.scheduler.call(self.bot.get_messages, chat, chunk, replies=0)
+            await out.put(messages)
+        await out.put(None)
+
+    async def _normalize(self, inp, out):
+        batch = []
+        lowest = None
+        while True:
+            messages = await inp.get()
+            if messages is None:
+                break
+            for message in messages:
+                self.checked += 1
+                lowest = message.id if lowest is None else min(lowest, message.id)
+                media = get_media(message)
+                if media is None:
+                    continue
+                doc = media_document(media)
+                if doc is not None:
+                    batch.append(doc)
+            if len(batch) >= self.batch_size:
+                await out.put((batch, lowest))
+                batch = []
+        if lowest is not None:
+            await out.put((batch, lowest))
+        await out.put(None)
+
+    async def _write(self, inp, on_progress):
+        while True:
+            item = await inp.get()
+            if item is None:
+                break
+            docs, lowest = item
+            inserted = await insert_documents(docs)
+            self.files += len(docs)
+            self.saved += len(inserted)
+            if on_progress is not None:
+                await on_progress(lowest)
+
+
+async def _history_chunk(user_bot, chat, offset_id, limit=HISTORY_CHUNK):
+    return [message.id async for message in user_bot.get_chat_history(chat, limit=limit, offset_id=offset_id)]
+
+
+async def history_ids(user_bot, chat, scheduler, offset_id=0, stop_at=0):
+    """
+    Yield message ids of a chat older than `offset_id` (0 for the latest) and newer than `stop_at`, newest first.
+    History is read one request at a time through `scheduler`, so a FloodWait pauses the job instead of failing it.
+    """
+    while True:
+        ids = await scheduler.call(_history_chunk, user_bot, chat, offset_id)
+        if not ids:
+            return
+        for message_id in ids:
+            if message_id <= stop_at:
+                return
+            yield message_id
+        offset_id = ids[-1]
+
+
+class IndexJob:
+    """
+    Checkpointed indexing of one chat.
+    The checkpoint stores the id range [oldest, newest] that is already indexed and whether
+    everything below it is done too. A job first indexes messages newer than `newest`, then
+    (unless incremental on a chat indexed before) keeps walking down from `oldest`, saving `oldest` after every batch,
+    so a crashed or interrupted job continues where it stopped.
+    """
+
+    def __init__(self, user_bot, bot, chat, scheduler, incremental=False):
+        self.user_bot = user_bot
+        self.chat = chat
+        self.scheduler = scheduler
+        self.incremental = incremental
+        self.ingester = Ingester(bot, scheduler)
+        self.started = time.monotonic()
+        self.remaining = None
+        self.finished = False
+
+    async def run(self):
+        self.started = time.monotonic()
+        chat = await self.scheduler.call(self.user_bot.get_chat, self.chat)
+        chat_id = chat.id
+        latest = await self.scheduler.call(_history_chunk, self.user_bot, chat_id, 0, limit=1)
+        top = latest[0] if latest else 0
+
+        checkpoint = await get_checkpoint(chat_id)
+        full = not self.incremental
+        if checkpoint is None:
+            checkpoint = {"newest": top, "oldest": top + 1, "done": False}
+            await save_checkpoint(chat_id, **checkpoint)
+            # nothing was indexed before, every message is new
+            full = True
+        else:
+            # messages posted since the last run, the checkpoint only moves once all of them are written
+            self.remaining = top - checkpoint["newest"]
+            await self.ingester.run(
+                chat_id, history_ids(self.user_bot, chat_id, self.scheduler, stop_at=checkpoint["newest"]),
+            )
+            await save_checkpoint(chat_id, newest=top)
+
+        if full and not checkpoint["done"]:
+            oldest = checkpoint["oldest"]
+            checked = self.ingester.checked
+            self.remaining = oldest - 1
+
+            async def on_progress(lowest):
+                self.remaining = max(lowest - 1, 0)
+                await save_checkpoint(chat_id, oldest=lowest)
+
+            await self.ingester.run(
+                chat_id, history_ids(self.user_bot, chat_id, self.scheduler, offset_id=oldest), on_progress,
+            )
+            await save_checkpoint(chat_id, oldest=1, done=True)
+            logger.info(f"Indexed {self.ingester.checked - checked} old messages of {chat_id}")
+
+        self.remaining = 0
+        self.finished = True
+
+    def progress(self):
+        """One line progress report with throughput and ETA"""
+        ingester = self.ingester
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        msgs_rate = ingester.checked / elapsed
+        files_rate = ingester.saved / elapsed
+        text = (f"{self.chat}: {ingester.checked} checked ({msgs_rate:.1f} msgs/s), "
+                f"{ingester.saved} saved ({files_rate:.1f} files/s)")
+        if self.finished:
+            return text + ", done"
+        if self.remaining and msgs_rate:
+            text += f", ETA {int(self.remaining / msgs_rate)}s"
+        return text
+
+
+class WriteBuffer:
+    """
+    Write-behind buffer for files posted in indexed channels.
+    Documents are flushed with one unordered insert_many when `max_batch` are waiting or
+    `max_delay` seconds after the first one arrived. `put` waits while `max_pending`
+    documents are queued, which slows down the update handlers when MongoDB can't keep up.
+    """
+
+    def __init__(self, max_batch=500, max_delay=1.0, max_pending=5000):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.queue = None
+        self.task = None
+        self.flushes = 0
+        self.flushed = 0
+
+    async def put(self, doc):
+        if self.task is None:
+            self.queue = asyncio.Queue(self.max_pending)
+            self.task = asyncio.ensure_future(self._run())
+        await self.queue.put(doc)
+
+    async def close(self):
+        """Flush everything still buffered and stop the background task"""
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        closed = False
+        while not closed:
+            doc = await self.queue.get()
+            if doc is None:
+                break
+
+            batch = [doc]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    closed = True
+                    break
+                batch.append(doc)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            inserted = await insert_documents(batch)
+        except Exception:
+            logger.exception(f"Failed to save {len(batch)} buffered files")
+            return
+        elapsed = (time.monotonic() - started) * 1000
+        flush_latency.observe(elapsed)
+        self.flushes += 1
+        self.flushed += len(batch)
+        logger.info(f"Flushed {len(batch)} buffered files ({len(inserted)} new) in "
+                    f"{elapsed:.0f} ms, {self.queue.qsize()} pending")
+
+
+write_buffer = WriteBuffer(max_batch=WRITE_BUFFER_SIZE, max_delay=WRITE_BUFFER_DELAY)
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+current_trace = ContextVar("search_trace", default=None)
+started = time.time()
+
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SIZE_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class SearchTrace:
+    """Which stage answered a search, how many documents it looked at and whether the answer holds every match"""
+
+    __slots__ = ("stage", "scanned", "complete")
+
+    def __init__(self):
+        self.stage = None
+        self.scanned = 0
+        self.complete = False
+
+
+def record_search(stage, scanned=0):
+    """Attribute a search to `stage`, a no-op unless the caller set `current_trace`"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.stage = stage
+        trace.scanned += scanned
+
+
+def record_complete():
+    """Mark the answer of the current search as the last page of every match, not one cut short by a scan limit"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.complete = True
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label=None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        for label, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            yield self.name, self._labels(label), value
+
+    def _labels(self, label, extra=""):
+        labels = [f'{self.label}="{label}"'] if self.label and label is not None else []
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Histogram(Counter):
+    """Fixed bucket histogram, cheap enough to observe on every request"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, value, label=None):
+        entry = self.values.get(label)
+        if entry is None:
+            entry = self.values[label] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def count(self, label=None):
+        entry = self.values.get(label)
+        return entry[1] if entry else 0
+
+    def percentile(self, pct, label=None):
+        """Upper bound of the bucket holding the pct-th percentile"""
+        entry = self.values.get(label)
+        if not entry or not entry[1]:
+            return 0
+        rank = entry[1] * pct / 100
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), entry[0]):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for label, (counts, count, total) in sorted(self.values.items(), key=lambda item: str(item[0])):
+            seen = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                seen += n
+                yield self.name + "_bucket", self._labels(label, f'le="{bound}"'), seen
+            yield self.name + "_count", self._labels(label), count
+            yield self.name + "_sum", self._labels(label), total
+
+
+class Observed:
+    """Metric read from an existing counter or size when rendered"""
+
+    def __init__(self, name, help, func, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.func()
+
+
+search_latency = Histogram("search_latency_ms", "get_search_results latency by answering stage", "stage")
+search_scanned = Histogram("search_scanned_docs", "Documents looked at per search", "stage", SIZE_BUCKETS)
+files_ingested = Counter("files_ingested_total", "Files written to the database", "result")
+flush_latency = Histogram("write_buffer_flush_ms", "Write-behind buffer flush latency")
+flood_waits = Counter("flood_wait_seconds_total", "Seconds slept because of FloodWait")
+mongo_commands = Counter("mongo_commands_total", "MongoDB round trips", "command")
+mongo_latency = Histogram("mongo_command_ms", "MongoDB round trip latency", "command")
+
+METRICS = [search_latency, search_scanned, files_ingested, flush_latency, flood_waits, mongo_commands, mongo_latency]
+
+
+def observe(name, help, func, kind="gauge"):
+    """Export the value returned by `func` as a metric"""
+    metric = Observed(name, help, func, kind)
+    METRICS.append(metric)
+    return metric
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Counts every MongoDB command, pass it in the client's event_listeners"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_commands.inc(label=event.command_name)
+        mongo_latency.observe(event.duration_micros / 1000, label=event.command_name)
+
+    def failed(self, event):
+        mongo_commands.inc(label=event.command_name)
+        mongo_latency.observe(event.duration_micros / 1000, label=event.command_name)
+
+
+def render_prometheus():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    lines.append(f"process_uptime_seconds {time.time() - started:.0f}")
+    return "\n".join(lines) + "\n"
+
+
+async def _serve(reader, writer):
+    try:
+        await reader.readline()
+        body = render_prometheus().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Failed to serve metrics: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port):
+    """Serve render_prometheus() over HTTP on every path of `port`"""
+    server = await asyncio.start_server(_serve, port=port)
+    logger.info(f"Serving Prometheus metrics on port {port}")
+    return server
@@ -0,0 +1,77 @@
+import base64
+import binascii
+import struct
+import zlib
+
+from bson import ObjectId
+
+# Telegram rejects inline query offsets longer than this
+MAX_OFFSET_LENGTH = 64
+
+
+def query_fingerprint(*parts):
+    """32 bit fingerprint of everything that defines a result list"""
+    return zlib.crc32("\x1f".join(str(p) for p in parts).encode())
+
+
+def _encode_key(key):
+    if isinstance(key, tuple):
+        score, inner = key
+        return b"r" + struct.pack(">q", score) + _encode_key(inner)
+    if isinstance(key, ObjectId):
+        return b"o" + key.binary
+    if isinstance(key, str):
+        return b"s" + key.encode()
+    return b"i" + struct.pack(">Q", key)
+
+
+def _decode_key(raw):
+    kind, payload = raw[:1], raw[1:]
+    if kind == b"o" and len(payload) == 12:
+        return ObjectId(payload)
+    if kind == b"i" and len(payload) == 8:
+        return struct.unpack(">Q", payload)[0]
+    if kind == b"s" and payload:
+        try:
+            return payload.decode()
+        except UnicodeDecodeError:
+            return None
+    if kind == b"r" and len(payload) > 8:
+        inner = _decode_key(payload[8:])
+        if inner is not None and not isinstance(inner, tuple):
+            return struct.unpack(">q", payload[:8])[0], inner
+    return None
+
+
+def encode_offset(fingerprint, key):
+    """
+    Return an opaque next_offset that resumes right after `key`.
+    `key` is an in-memory index sequence number (int), a Media `created` ObjectId, the `_id` (str)
+    of a file saved before `created` existed, or a (relevance score, one of those) pair for ranked results.
+    """
+    token = base64.urlsafe_b64encode(struct.pack(">I", fingerprint) + _encode_key(key)).decode().rstrip("=")
+    if len(token) > MAX_OFFSET_LENGTH:
+        raise ValueError(f"Offset token is {len(token)} bytes long")
+    return token
+
+
+def decode_offset(offset, fingerprint):
+    """Return the key encoded by `encode_offset`, or None to start from the first page"""
+    if not offset or not isinstance(offset, str):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(offset + "=" * (-len(offset) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) < 5 or struct.unpack(">I", raw[:4])[0] != fingerprint:
+        return None
+    return _decode_key(raw[4:])
+
+
+def key_source(key):
+    """Return "index" or "mongo" depending on which search path produced an offset key, None for no key"""
+    if isinstance(key, tuple):
+        key = key[1]
+    if key is None:
+        return None
+    return "mongo" if isinstance(key, (ObjectId, str)) else "index"
@@ -0,0 +1,52 @@
+import time
+import heapq
+from operator import itemgetter
+
+
+class QueryLog:
+    """
+    Approximate most frequent queries kept in `capacity` counters (Space-Saving).
+    A query without a counter takes over the one of the least counted query, so every query with more
+    than total / capacity hits keeps its counter, over-counted by at most what it took over.
+    Counts are halved every `half_life` seconds, so the log follows what is popular now.
+    Keys are any hashable, like (normalized query, file_type, size_range).
+    """
+
+    def __init__(self, capacity=1000, half_life=3600):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.counts = {}
+        self.decayed = time.monotonic()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _decay(self):
+        now = time.monotonic()
+        if now - self.decayed < self.half_life:
+            return
+        self.decayed = now
+        self.counts = {key: count // 2 for key, count in self.counts.items() if count > 1}
+
+    def record(self, key):
+        self._decay()
+        count = self.counts.get(key)
+        if count is None and len(self.counts) >= self.capacity:
+            # a linear scan of the counters, cheaper than keeping them ordered for every known query hit
+            victim = min(self.counts, key=self.counts.get)
+            count = self.counts.pop(victim)
+        self.counts[key] = (count or 0) + 1
+
+    def top(self, n):
+        """The `n` most counted (key, count), most counted first"""
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def dump(self):
+        return list(self.counts.items())
+
+    def load(self, items):
+        """Add counts saved by dump(), from a previous run"""
+        for key, count in items:
+            self.counts[key] = self.counts.get(key, 0) + count
+        if len(self.counts) > self.capacity:
+            self.counts = dict(self.top(self.capacity))
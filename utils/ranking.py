@@ -0,0 +1,74 @@
+import heapq
+
+from bson import ObjectId
+
+from .search_index import normalize
+
+CAPTION_WEIGHT = 0.5
+RECENCY_WEIGHT = 0.3
+# a candidate this much older than the newest one gets half the recency bonus:
+# days between `created` of files read from the database, files saved in between for the in-memory index
+RECENCY_DAYS = 30
+RECENCY_FILES = 5000
+
+
+def text_score(text, parts, phrase):
+    """
+    Relevance of one text for the normalized query words:
+    token coverage (whole word > word prefix > substring) averaged over the words,
+    plus a bonus when the words are adjacent in order and another when the text starts with them.
+    """
+    text = normalize(text)
+    if not text:
+        return 0.0
+
+    words = text.split()
+    coverage = 0.0
+    for part in parts:
+        if part in words:
+            coverage += 1.0
+        elif any(word.startswith(part) for word in words):
+            coverage += 0.7
+        elif part in text:
+            coverage += 0.4
+
+    score = coverage / len(parts)
+    if phrase in text:
+        score += 0.5
+        if text.startswith(phrase):
+            score += 0.5
+    return score
+
+
+def _age(key, newest):
+    """How much older a candidate key (a `created` ObjectId or an index sequence number) is than `newest`, in RECENCY_DAYS or RECENCY_FILES"""
+    if isinstance(key, ObjectId):
+        return (newest.generation_time - key.generation_time).total_seconds() / (RECENCY_DAYS * 86400)
+    return (newest - key) / RECENCY_FILES
+
+
+def rank(candidates, parts, limit, after=None, use_caption=False):
+    """
+    Return the `limit` best (score, key, doc) of `candidates`, best first.
+    `candidates` are (key, doc) pairs; recency comes from the age of the key relative to the newest one,
+    so a candidate scores the same on every page even if older ones were deleted in between.
+    Scores are integers so (score, key) pairs can be stored in a page offset and passed back as `after`.
+    Only a heap of `limit` items is kept, the candidate list itself is never sorted.
+    """
+    if not candidates or not parts:
+        return []
+
+    phrase = " ".join(parts)
+    newest = max(key for key, _ in candidates)
+
+    def scored():
+        for key, doc in candidates:
+            score = text_score(doc.get("file_name"), parts, phrase)
+            if use_caption:
+                score = max(score, CAPTION_WEIGHT * text_score(doc.get("caption"), parts, phrase))
+            score += RECENCY_WEIGHT / (1 + _age(key, newest))
+            item = (round(score * 10000), key, doc)
+            if after is None or (item[0], item[1]) < after:
+                yield item
+
+    return heapq.nlargest(limit, scored(), key=lambda item: (item[0], item[1]))
@@ -0,0 +1,169 @@
+import time
+import asyncio
+import logging
+
+from pyrogram.errors import FloodWait
+
+from .metrics import flood_waits
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Run at most one call per key at a time, concurrent callers await the same result"""
+
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        # shield, so one impatient caller being cancelled doesn't cancel the search for everyone else
+        return await asyncio.shield(future)
+
+
+class Debouncer:
+    """
+    Per user debounce: wait `delay` seconds and report whether the update is still the user's latest.
+    Telegram sends one inline update per keystroke, earlier ones are superseded by the time we answer.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.latest = {}
+        self.dropped = 0
+
+    async def wait(self, user_id):
+        if self.delay <= 0:
+            return True
+
+        marker = object()
+        self.latest[user_id] = marker
+        await asyncio.sleep(self.delay)
+        if self.latest.get(user_id) is not marker:
+            self.dropped += 1
+            return False
+        del self.latest[user_id]
+        return True
+
+
+class RateLimiter:
+    """
+    Per user token buckets: a user starts with `burst` tokens, refilled at `rate` per second.
+    allow takes a token up front, so parallel requests can't all pass, and callers charge what a request
+    cost on top once it finished, so users of slow searches run out sooner than users of cheap ones.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # user id -> (tokens, monotonic time they were counted)
+        self.buckets = {}
+        self.limited = 0
+
+    def _tokens(self, user_id, now):
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allow(self, user_id):
+        """Take a token of the user, False if there is none left"""
+        if self.rate <= 0:
+            return True
+        if self._tokens(user_id, time.monotonic()) >= 1:
+            self.charge(user_id, 1)
+            return True
+        self.limited += 1
+        return False
+
+    def charge(self, user_id, cost):
+        """Take `cost` more tokens, the bucket may go negative and then takes longer to refill"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.buckets[user_id] = (self._tokens(user_id, now) - cost, now)
+        if len(self.buckets) > self.maxsize:
+            # users whose bucket refilled since are the same as users never seen
+            self.buckets = {
+                user: (tokens, updated) for user, (tokens, updated) in self.buckets.items()
+                if tokens + (now - updated) * self.rate < self.burst
+            }
+
+
+class Overloaded(Exception):
+    """Raised instead of starting work a ConcurrencyLimit has no slot for"""
+
+
+class ConcurrencyLimit:
+    """At most `limit` holders at a time. try_acquire never waits, callers without a slot do something cheaper"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.shed = 0
+
+    def try_acquire(self):
+        if self.running >= self.limit:
+            self.shed += 1
+            return False
+        self.running += 1
+        return True
+
+    def release(self):
+        self.running -= 1
+
+
+class FloodScheduler:
+    """
+    Token bucket shared by everything that calls Telegram for one job.
+    A FloodWait on any call pauses every caller until Telegram allows requests again.
+    """
+
+    def __init__(self, rate=10.0, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.flood_waits = 0
+        self.flood_seconds = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def flood_wait(self, seconds):
+        self.flood_waits += 1
+        self.flood_seconds += seconds
+        flood_waits.inc(seconds)
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        logger.warning(f"FloodWait of {seconds}s, pausing Telegram requests")
+
+    async def call(self, func, *args, retries=5, **kwargs):
+        """Await func(*args, **kwargs) within the rate limit, retrying after FloodWait"""
+        for attempt in range(retries):
+            await self.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                if attempt == retries - 1:
+                    raise
+                self.flood_wait(e.value)
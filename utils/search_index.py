@@ -0,0 +1,257 @@
+import re
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+from .facets import accepts
+
+logger = logging.getLogger(__name__)
+
+_separators = re.compile(r"[^0-9a-zA-Z\u00C0-\u024F]+")
+
+
+def normalize(text):
+    """Lowercase text and collapse everything except letters and digits to single spaces"""
+    return _separators.sub(" ", text or "").strip().lower()
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def search_terms(*texts):
+    """Return sorted (tokens, trigrams) of the given texts, as stored on Media documents"""
+    tokens = set()
+    for text in texts:
+        tokens.update(normalize(text).split())
+    grams = set()
+    for token in tokens:
+        grams.update(trigrams(token))
+    return sorted(tokens), sorted(grams)
+
+
+def build_regex(query):
+    """Return (parts, compiled regex) used by every search path"""
+    parts = normalize(query).split()
+    if parts:
+        pattern = ".*".join(re.escape(p) for p in parts)
+    else:
+        pattern = re.escape(query.strip())
+    return parts, re.compile(pattern, re.IGNORECASE)
+
+
+class SearchIndex:
+    """
+    In-memory trigram index of the Media collection.
+    Every document gets an increasing sequence number, so posting lists and
+    `order` are append-only sorted arrays and newest-first is a reverse walk.
+    Removed documents are dropped from `docs` and skipped lazily everywhere else.
+    Results are (seq, doc) pairs, pass the last seq as `before` to get the next page.
+    An index can start from a snapshot (see load), which then holds the first sequence numbers and
+    whose posting lists are decoded into `postings` the first time a query needs them.
+    """
+
+    # Queries made only of 1-2 character words have no trigrams, scan this many newest docs at most
+    SHORT_SCAN_LIMIT = 1000
+
+    def __init__(self, use_caption=False):
+        self.use_caption = use_caption
+        self.ready = False
+        self.seq = 0
+        # candidates looked at by search/recent, for instrumentation
+        self.scanned = 0
+        self.docs = {}
+        self.order = array("L")
+        self.ids = {}
+        self.postings = {}
+        # newest `created` indexed, where a snapshot of this index has to be caught up from
+        self.watermark = None
+        # read-only Snapshot holding sequence numbers 1..base.count, with the ones removed since
+        self.base = None
+        self.removed = set()
+        self.loaded = set()
+
+    def __len__(self):
+        if self.base is None:
+            return len(self.docs)
+        return self.base.count - len(self.removed) + len(self.docs)
+
+    def load(self, snapshot):
+        """Start from a Snapshot instead of an empty index, documents added later are numbered after it"""
+        self.base = snapshot
+        self.seq = snapshot.count
+        self.watermark = snapshot.watermark
+
+    def _doc(self, seq):
+        if self.base is not None and seq <= self.base.count:
+            return None if seq in self.removed else self.base.doc(seq)
+        return self.docs.get(seq)
+
+    def _seq(self, file_id):
+        seq = self.ids.get(file_id)
+        if seq is None and self.base is not None:
+            seq = self.base.find(file_id)
+            if seq in self.removed:
+                return None
+        return seq
+
+    def _posting(self, gram):
+        posting = self.postings.get(gram)
+        if self.base is not None and gram not in self.loaded:
+            self.loaded.add(gram)
+            base = self.base.posting(gram)
+            if base:
+                base.extend(posting or ())
+                posting = self.postings[gram] = base
+        return posting or ()
+
+    def has_gram(self, gram):
+        """Whether some indexed document has `gram`, without decoding a snapshot posting list"""
+        return bool(self.postings.get(gram)) or (self.base is not None and gram in self.base)
+
+    def _grams(self, doc):
+        texts = [doc.get("file_name")]
+        if self.use_caption:
+            texts.append(doc.get("caption"))
+        return search_terms(*texts)[1]
+
+    def add(self, doc):
+        """Index a raw Media document, returns False if it is already indexed"""
+        file_id = str(doc["_id"])
+        if self._seq(file_id) is not None:
+            return False
+        created = doc.get("created")
+        if created is not None and (self.watermark is None or created > self.watermark):
+            self.watermark = created
+
+        self.seq += 1
+        seq = self.seq
+        self.ids[file_id] = seq
+        self.order.append(seq)
+        self.docs[seq] = {
+            "file_id": file_id,
+            "file_name": doc.get("file_name"),
+            "file_size": doc.get("file_size"),
+            "file_type": doc.get("file_type"),
+            "caption": doc.get("caption"),
+        }
+        for gram in self._grams(doc):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("I")
+            posting.append(seq)
+        return True
+
+    def remove(self, file_id):
+        """Forget a document, its posting entries are skipped until the next rebuild"""
+        file_id = str(file_id)
+        seq = self.ids.pop(file_id, None)
+        if seq is not None:
+            del self.docs[seq]
+            return True
+        seq = self._seq(file_id)
+        if seq is None:
+            return False
+        self.removed.add(seq)
+        return True
+
+    def _matches(self, doc, regex, file_type, size_range):
+        if not accepts(doc, file_type, size_range):
+            return False
+        if regex.search(doc["file_name"] or ""):
+            return True
+        return self.use_caption and bool(regex.search(doc["caption"] or ""))
+
+    @staticmethod
+    def _newest(seqs, before):
+        """Iterate a sorted sequence array newest first, starting below `before`"""
+        end = len(seqs) if before is None else bisect_left(seqs, before)
+        for i in range(end - 1, -1, -1):
+            yield seqs[i]
+
+    def _order(self, before):
+        """Iterate every sequence number newest first, starting below `before`"""
+        yield from self._newest(self.order, before)
+        if self.base is not None:
+            end = self.base.count if before is None else min(before - 1, self.base.count)
+            yield from range(end, 0, -1)
+
+    def _walk(self, parts, before):
+        """Yield candidate sequence numbers newest first"""
+        grams = set()
+        for part in parts:
+            grams.update(trigrams(part))
+
+        if not grams:
+            yield from islice(self._order(before), self.SHORT_SCAN_LIMIT)
+            return
+
+        lists = sorted((self._posting(gram) for gram in grams), key=len)
+        rarest, others = lists[0], lists[1:]
+        for seq in self._newest(rarest, before):
+            for posting in others:
+                i = bisect_left(posting, seq)
+                if i == len(posting) or posting[i] != seq:
+                    break
+            else:
+                yield seq
+
+    def search(self, query, file_type=None, limit=10, before=None, size_range=None):
+        """Return up to `limit` matching documents older than `before`, newest first"""
+        parts, regex = build_regex(query)
+        results = []
+        if not parts:
+            return results
+
+        for seq in self._walk(parts, before):
+            self.scanned += 1
+            doc = self._doc(seq)
+            if doc is not None and self._matches(doc, regex, file_type, size_range):
+                results.append((seq, doc))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def recent(self, file_type=None, limit=10, before=None, size_range=None):
+        results = []
+        for seq in self._order(before):
+            self.scanned += 1
+            doc = self._doc(seq)
+            if doc is not None and accepts(doc, file_type, size_range):
+                results.append((seq, doc))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def export(self):
+        """
+        Contents for write_snapshot as (docs, postings, watermark) iterators. Only cheap copies are
+        taken here, the iterators can be consumed in another thread while the index keeps changing.
+        """
+        base, removed, docs = self.base, set(self.removed), dict(self.docs)
+        cut = base.count if base is not None else 0
+        live = {gram: posting[bisect_right(posting, cut):] for gram, posting in list(self.postings.items())}
+
+        def iter_docs():
+            if base is not None:
+                for seq in range(1, base.count + 1):
+                    if seq not in removed:
+                        yield seq, base.doc(seq)
+            yield from docs.items()
+
+        def iter_postings():
+            grams = set(live)
+            if base is not None:
+                grams.update(base.grams())
+            for gram in sorted(grams):
+                added = live.get(gram)
+                if base is not None and not added:
+                    # written straight from the snapshot's mapped pages
+                    yield gram, base.posting_view(gram)
+                    continue
+                posting = base.posting(gram) if base is not None else array("I")
+                posting.extend(added)
+                yield gram, posting
+
+        return iter_docs(), iter_postings(), self.watermark
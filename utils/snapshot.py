@@ -0,0 +1,267 @@
+import os
+import mmap
+import struct
+import logging
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from .facets import FILE_TYPES
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MSBI"
+VERSION = 2
+# magic, version, flags, documents, terms, words, watermark, taken, then the offset of every section
+SECTIONS = ("sizes", "types", "texts", "ids", "terms", "postings", "words", "counts", "blob")
+_header = struct.Struct(f"<4sHHQQQ12s12s{len(SECTIONS)}Q")
+# deletions and files saved this long before a snapshot are applied again, both are idempotent
+CATCH_UP_MARGIN = timedelta(minutes=5)
+# deletions are logged for this long, snapshots taken before that can't be caught up anymore and are ignored
+DELETIONS_TTL = timedelta(days=7)
+
+
+class _Strings:
+    """Byte strings concatenated in a blob with an offsets array, string i is blob[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self):
+        self.offsets = array("Q", [0])
+        self.blob = bytearray()
+
+    def append(self, data):
+        self.blob += data
+        self.offsets.append(len(self.blob))
+
+
+def write_snapshot(path, docs, postings, words, watermark, taken, use_caption):
+    """
+    Write a compact snapshot of a search index to `path`, atomically replacing the previous one.
+    `docs` iterates (seq, doc) in ascending seq order and is consumed before `postings`, which iterates
+    (gram, ascending seqs as an "I" array or memoryview) in gram order and may reference documents that are gone.
+    Documents are numbered 1..n again, so removed documents take no space; when none were removed the posting
+    lists are copied as they are. `words` maps spelling vocabulary words to counts.
+    `watermark` is the newest `created` in the index and `taken` an ObjectId from before it was copied,
+    they tell open_snapshot's caller which files and deletions to catch up on.
+    Returns the number of documents written.
+    """
+    renumber = {}
+    # whether documents keep their numbers, every seq up to the last one being there
+    same = True
+    sizes = array("q")
+    types = bytearray()
+    texts = _Strings()
+    ids = []
+    for seq, doc in docs:
+        renumber[seq] = len(renumber) + 1
+        same = same and seq == len(renumber)
+        file_id = doc["file_id"].encode()
+        sizes.append(-1 if doc.get("file_size") is None else doc["file_size"])
+        file_type = doc.get("file_type")
+        types.append(FILE_TYPES.index(file_type) + 1 if file_type in FILE_TYPES else 0)
+        texts.append(file_id)
+        texts.append((doc.get("file_name") or "").encode())
+        texts.append((doc.get("caption") or "").encode())
+        ids.append((file_id, len(renumber)))
+    ids.sort()
+    ids = array("I", (seq for _, seq in ids))
+
+    terms = _Strings()
+    encoded = _Strings()
+    for gram, seqs in postings:
+        if same:
+            kept = seqs[:bisect_right(seqs, len(renumber))]
+        else:
+            kept = array("I", (renumber[seq] for seq in seqs if seq in renumber))
+        if len(kept):
+            terms.append(gram.encode())
+            encoded.blob += kept
+            encoded.offsets.append(len(encoded.blob))
+
+    vocabulary = _Strings()
+    counts = array("I")
+    for word in sorted(words):
+        vocabulary.append(word.encode())
+        counts.append(words[word])
+
+    sections = {
+        "sizes": sizes.tobytes(),
+        "types": bytes(types),
+        "texts": texts.offsets.tobytes(),
+        "ids": ids.tobytes(),
+        "terms": terms.offsets.tobytes(),
+        "postings": encoded.offsets.tobytes(),
+        "words": vocabulary.offsets.tobytes(),
+        "counts": counts.tobytes(),
+    }
+    # one blob holds every posting list and string, the offsets arrays above are relative to their own part.
+    # Posting lists come first so they stay aligned for casting
+    blob = (encoded.blob, texts.blob, terms.blob, vocabulary.blob)
+    parts = [len(part) for part in blob[:-1]]
+
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        position = _header.size + 3 * 8
+        offsets = []
+        for name in SECTIONS[:-1]:
+            position += -position % 8
+            offsets.append(position)
+            position += len(sections[name])
+        position += -position % 8
+        offsets.append(position)
+        f.write(_header.pack(MAGIC, VERSION, int(use_caption), len(sizes), len(terms.offsets) - 1, len(counts),
+                             watermark.binary if watermark else bytes(12), taken.binary, *offsets))
+        f.write(struct.pack("<3Q", *parts))
+        for name, offset in zip(SECTIONS, offsets):
+            f.write(bytes(offset - f.tell()))
+            if name != "blob":
+                f.write(sections[name])
+        for part in blob:
+            f.write(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+    return len(sizes)
+
+
+class Snapshot:
+    """
+    Read-only view of a file written by write_snapshot, memory-mapped so opening it costs the same
+    for any size and processes opening the same file share its pages.
+    Documents are numbered 1..count in `created` order, fixed width metadata are arrays cast straight
+    from the mapping, so are posting lists, and strings are only decoded when asked for.
+    Arrays use the native byte order, snapshots are not meant to be moved between machines.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, flags, self.count, self.terms, self.words, watermark, taken,
+         *offsets) = _header.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} search index snapshot")
+        self.use_caption = bool(flags & 1)
+        self.watermark = ObjectId(watermark) if any(watermark) else None
+        self.taken = ObjectId(taken)
+
+        view = memoryview(self.map)
+        ends = offsets[1:]
+        section = {name: view[start:end] for name, start, end in zip(SECTIONS, offsets, ends)}
+        self.sizes = section["sizes"][:8 * self.count].cast("q")
+        self.types = section["types"][:self.count]
+        self.texts = section["texts"][:8 * (3 * self.count + 1)].cast("Q")
+        self.ids = section["ids"][:4 * self.count].cast("I")
+        self.term_offsets = section["terms"][:8 * (self.terms + 1)].cast("Q")
+        self.posting_offsets = section["postings"][:8 * (self.terms + 1)].cast("Q")
+        self.word_offsets = section["words"][:8 * (self.words + 1)].cast("Q")
+        self.counts = section["counts"][:4 * self.words].cast("I")
+        postings, texts, terms = struct.unpack_from("<3Q", self.map, _header.size)
+        blob = offsets[-1]
+        self.postings = view[blob:blob + postings].cast("I")
+        self.text_blob = view[blob + postings:blob + postings + texts]
+        self.term_blob = view[blob + postings + texts:blob + postings + texts + terms]
+        self.word_blob = view[blob + postings + texts + terms:]
+
+    def _text(self, i):
+        return bytes(self.text_blob[self.texts[i]:self.texts[i + 1]])
+
+    def doc(self, seq):
+        """Document `seq` in the form SearchIndex keeps them"""
+        i = seq - 1
+        size = self.sizes[i]
+        file_type = self.types[i]
+        return {
+            "file_id": self._text(3 * i).decode(),
+            "file_name": self._text(3 * i + 1).decode() or None,
+            "file_size": None if size < 0 else size,
+            "file_type": FILE_TYPES[file_type - 1] if file_type else None,
+            "caption": self._text(3 * i + 2).decode() or None,
+        }
+
+    def find(self, file_id):
+        """Sequence number of a file id, or None"""
+        key = file_id.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            seq = self.ids[middle]
+            if self._text(3 * (seq - 1)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._text(3 * (self.ids[low] - 1)) == key:
+            return self.ids[low]
+        return None
+
+    def _term(self, i):
+        return bytes(self.term_blob[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+    def _find_term(self, gram):
+        key = gram.encode()
+        low, high = 0, self.terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.terms or self._term(low) != key:
+            return None
+        return low
+
+    def __contains__(self, gram):
+        return self._find_term(gram) is not None
+
+    def posting_view(self, gram):
+        """Read-only "I" memoryview of the ascending sequence numbers having `gram`, empty if none"""
+        i = self._find_term(gram)
+        if i is None:
+            return self.postings[:0]
+        return self.postings[self.posting_offsets[i] // 4:self.posting_offsets[i + 1] // 4]
+
+    def posting(self, gram):
+        """New array of the ascending sequence numbers having `gram`, empty if none"""
+        posting = array("I")
+        posting.frombytes(self.posting_view(gram).cast("B"))
+        return posting
+
+    def grams(self):
+        for i in range(self.terms):
+            yield self._term(i).decode()
+
+    def vocabulary(self):
+        """(word, count) of the spelling vocabulary"""
+        for i in range(self.words):
+            yield bytes(self.word_blob[self.word_offsets[i]:self.word_offsets[i + 1]]).decode(), self.counts[i]
+
+
+def open_snapshot(path, use_caption):
+    """Snapshot at `path`, or None if there is none or it can't be used with these settings"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"Ignoring search index snapshot: {e}")
+        return None
+    if snapshot.use_caption != use_caption:
+        logger.warning("Ignoring search index snapshot written with a different USE_CAPTION_FILTER")
+        return None
+    if snapshot.taken.generation_time < datetime.now(timezone.utc) - DELETIONS_TTL + CATCH_UP_MARGIN:
+        logger.warning("Ignoring search index snapshot older than the deletions log")
+        return None
+    return snapshot
+
+
+def catch_up_filters(snapshot):
+    """
+    (deletions filter, Media filter) selecting what changed since `snapshot` was taken,
+    or ({}, {}) selecting everything without a snapshot. Deletions are applied before new files.
+    """
+    if snapshot is None:
+        return {}, {}
+    deleted = {"_id": {"$gte": ObjectId.from_datetime(snapshot.taken.generation_time - CATCH_UP_MARGIN)}}
+    if snapshot.watermark is None:
+        return deleted, {}
+    return deleted, {"created": {"$gte": ObjectId.from_datetime(snapshot.watermark.generation_time - CATCH_UP_MARGIN)}}
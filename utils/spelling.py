@@ -0,0 +1,132 @@
+from bisect import bisect_left, insort
+
+from .search_index import normalize
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance of a and b, or limit + 1 once it is known to exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SpellChecker:
+    """
+    SymSpell style typo correction over the words of indexed file names.
+    Every word registers its deletes (up to `max_distance` characters removed from its first
+    `prefix_length` characters), so a lookup only generates the deletes of the query word and
+    verifies the few words sharing one, instead of comparing against the whole vocabulary.
+    """
+
+    # shorter words, and words with digits (years, 1080p, x264), are never corrected
+    MIN_LENGTH = 4
+
+    def __init__(self, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.ready = False
+        self.counts = {}
+        # sorted vocabulary, a word that is the prefix of a known word is being typed, not misspelled
+        self.words = []
+        # delete -> word, or list of words when several share it
+        self.deletes = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _eligible(self, word):
+        return len(word) >= self.MIN_LENGTH and word.isalpha()
+
+    def _deletes(self, word):
+        edits = {word[:self.prefix_length]}
+        frontier = edits
+        for _ in range(self.max_distance):
+            frontier = {e[:i] + e[i + 1:] for e in frontier for i in range(len(e)) if len(e) > 1}
+            edits |= frontier
+        return edits
+
+    def add_text(self, text):
+        if self.max_distance <= 0:
+            return
+        for word in normalize(text).split():
+            if self._eligible(word):
+                self.add_word(word)
+
+    def add_word(self, word, count=1):
+        """Count a normalized word `count` more times"""
+        known = self.counts.get(word)
+        self.counts[word] = (known or 0) + count
+        if known is not None:
+            return
+        if self.ready:
+            insort(self.words, word)
+        else:
+            self.words.append(word)
+        for edit in self._deletes(word):
+            known = self.deletes.get(edit)
+            if known is None:
+                self.deletes[edit] = word
+            elif isinstance(known, list):
+                known.append(word)
+            else:
+                self.deletes[edit] = [known, word]
+
+    def finish(self):
+        """Called once the initial vocabulary is loaded, words added after that are inserted in order"""
+        self.words.sort()
+        self.ready = True
+
+    def known(self, word):
+        if word in self.counts:
+            return True
+        i = bisect_left(self.words, word)
+        return i < len(self.words) and self.words[i].startswith(word)
+
+    def suggest(self, word):
+        """Closest, then most frequent, vocabulary word within max_distance of `word`, or None"""
+        best = None
+        seen = set()
+        for edit in self._deletes(word):
+            known = self.deletes.get(edit)
+            if known is None:
+                continue
+            for candidate in (known,) if isinstance(known, str) else known:
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(word, candidate, self.max_distance)
+                if distance <= self.max_distance:
+                    key = (distance, -self.counts[candidate], candidate)
+                    if best is None or key < best:
+                        best = key
+        return best[2] if best else None
+
+    def correct(self, query, matches=None):
+        """
+        Return the normalized query with unknown words replaced by their suggestion, or None if nothing changed.
+        Words `matches` accepts are kept as typed: the vocabulary lacks words with digits, so "dune"
+        is unknown even though it matches "dune2021".
+        """
+        if not self.ready or self.max_distance <= 0:
+            return None
+        words = normalize(query).split()
+        changed = False
+        for i, word in enumerate(words):
+            if self._eligible(word) and not self.known(word) and not (matches is not None and matches(word)):
+                suggestion = self.suggest(word)
+                if suggestion is not None:
+                    words[i] = suggestion
+                    changed = True
+        return " ".join(words) if changed else None
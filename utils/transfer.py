@@ -0,0 +1,104 @@
+import os
+import gzip
+import asyncio
+from datetime import timedelta
+from itertools import islice
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+# incremental exports start this long before the watermark, writers stamp `created` before the insert lands
+WATERMARK_MARGIN = timedelta(minutes=5)
+# documents are copied as the bytes MongoDB sent, never decoded to dicts and encoded again
+RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+def read_batches(path, size):
+    """Lists of up to `size` raw documents of an export file, only one list is in memory at a time"""
+    with gzip.open(path, "rb") as f:
+        docs = bson.decode_file_iter(f, RAW)
+        while True:
+            batch = list(islice(docs, size))
+            if not batch:
+                return
+            yield batch
+
+
+async def export_documents(collection, path, mongo_filter=None, batch_size=5000, progress=None):
+    """
+    Stream the documents matching `mongo_filter` to `path` in `created` order: gzip compressed BSON documents
+    one after another, the layout of mongodump --gzip, so mongorestore reads it too.
+    The file is replaced atomically once complete. `progress` is awaited with the number written so far.
+    Returns (count, watermark), watermark being the `created` of the last document, the `since` of the next export.
+    """
+    raw = collection.with_options(codec_options=RAW)
+    count = 0
+    last = None
+    chunk = []
+    temp = path + ".tmp"
+    with gzip.open(temp, "wb", compresslevel=6) as f:
+        async for doc in raw.find(mongo_filter or {}).sort("created", 1).batch_size(batch_size):
+            chunk.append(doc.raw)
+            last = doc
+            if len(chunk) >= batch_size:
+                f.write(b"".join(chunk))
+                count += len(chunk)
+                chunk.clear()
+                if progress is not None:
+                    await progress(count)
+        f.write(b"".join(chunk))
+        count += len(chunk)
+    os.replace(temp, path)
+    return count, last.get("created") if last is not None else None
+
+
+async def import_documents(collection, path, batch_size=1000, parallel=4, progress=None):
+    """
+    Insert the documents of an export file with up to `parallel` unordered insert_many in flight,
+    the next batch being decompressed in a thread meanwhile. Documents already in the collection
+    are skipped, so an interrupted import can be run again and incremental exports may overlap.
+    `progress` is awaited with the number of documents read so far. Returns (inserted, skipped).
+    """
+    loop = asyncio.get_event_loop()
+    batches = read_batches(path, batch_size)
+    pending = set()
+    inserted = skipped = 0
+
+    async def insert(batch):
+        try:
+            result = await collection.insert_many(batch, ordered=False)
+            return len(result.inserted_ids), 0
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            return e.details["nInserted"], len(errors)
+
+    async def collect(return_when):
+        nonlocal pending, inserted, skipped
+        done, pending = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            added, duplicates = task.result()
+            inserted += added
+            skipped += duplicates
+        if progress is not None:
+            await progress(inserted + skipped)
+
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, next, batches, None)
+            if batch is None:
+                break
+            pending.add(asyncio.ensure_future(insert(batch)))
+            if len(pending) >= parallel:
+                await collect(asyncio.FIRST_COMPLETED)
+        if pending:
+            await collect(asyncio.ALL_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+        batches.close()
+    return inserted, skipped
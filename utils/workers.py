@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import threading
+
+from .search_index import SearchIndex, build_regex
+from .ranking import rank
+from .snapshot import open_snapshot, write_snapshot, catch_up_filters
+
+logger = logging.getLogger(__name__)
+
+INDEX_PROJECTION = {"file_name": 1, "file_size": 1, "file_type": 1, "caption": 1, "created": 1, "_id": 1}
+# sequence numbers are local to a worker, page keys handed out carry the worker as seq * MAX_WORKERS + worker
+MAX_WORKERS = 256
+
+
+def index_page(index, query, file_type, limit, after, ranked, size_range, candidates):
+    """
+    Answer one page from a SearchIndex, the CPU bound part of get_search_results.
+    An empty query lists recent files. Ranked queries score the newest `candidates` matches.
+    Returns (docs, next_key, scanned, complete), next_key being the `after` of the next page
+    (a sequence number, or a (score, sequence number) pair when ranked) or None on the last page,
+    complete whether that last page ends every match rather than a scan limit.
+    """
+    scanned = index.scanned
+    parts, _ = build_regex(query)
+    # queries of 1-2 letter words only look at the SHORT_SCAN_LIMIT newest files
+    exhaustive = any(len(part) >= 3 for part in parts)
+    if not query:
+        found = index.recent(file_type, limit, before=after, size_range=size_range)
+        exhaustive = False
+    elif ranked:
+        matches = index.search(query, file_type, candidates, size_range=size_range)
+        best = rank(matches, parts, limit, after, index.use_caption)
+        next_key = best[-1][:2] if len(best) == limit else None
+        complete = next_key is None and exhaustive and len(matches) < candidates
+        return [doc for _, _, doc in best], next_key, index.scanned - scanned, complete
+    else:
+        found = index.search(query, file_type, limit, before=after, size_range=size_range)
+    next_key = found[-1][0] if len(found) == limit else None
+    return [doc for _, doc in found], next_key, index.scanned - scanned, next_key is None and exhaustive
+
+
+def _serve(conn, use_caption, snapshot_path):
+    """Worker process: build a SearchIndex, then apply updates and answer pages sent over `conn`"""
+    from pymongo import MongoClient
+    from info import DATABASE_URI, DATABASE_NAME, COLLECTION_NAME
+
+    try:
+        index = SearchIndex(use_caption=use_caption)
+        snapshot = open_snapshot(snapshot_path, use_caption)
+        removed_filter, mongo_filter = catch_up_filters(snapshot)
+        client = MongoClient(DATABASE_URI)
+        database = client[DATABASE_NAME]
+        if snapshot is not None:
+            index.load(snapshot)
+            for deletion in database[COLLECTION_NAME + "_deletions"].find(removed_filter):
+                index.remove(deletion["file_id"])
+        for doc in database[COLLECTION_NAME].find(mongo_filter, INDEX_PROJECTION).sort("created", 1).batch_size(5000):
+            index.add(doc)
+        client.close()
+        index.ready = True
+        conn.send(len(index))
+
+        while True:
+            op, payload = conn.recv()
+            if op == "add":
+                for doc in payload:
+                    index.add(doc)
+            elif op == "remove":
+                for file_id in payload:
+                    index.remove(file_id)
+            elif op == "page":
+                conn.send(index_page(index, *payload))
+            elif op == "snapshot":
+                path, words, taken = payload
+                try:
+                    docs, postings, watermark = index.export()
+                    count = write_snapshot(path, docs, postings, words, watermark, taken, use_caption)
+                except OSError as e:
+                    logger.error(f"Failed to write search index snapshot: {e}")
+                    count = None
+                conn.send(count)
+            else:
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        # one request or update on the pipe at a time
+        self.lock = threading.Lock()
+        self.ready = False
+        self.inflight = 0
+        self.pending = []
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def request(self, message):
+        with self.lock:
+            self.conn.send(message)
+            return self.conn.recv()
+
+
+class SearchWorkers:
+    """
+    Pool of processes that each hold a copy of the search index and answer index pages,
+    so matching and ranking use several cores instead of the bot's single GIL.
+    The bot process keeps talking to Telegram and MongoDB, sends every saved or deleted
+    file to all workers and each page to the least busy ready worker.
+    Blocking pipe I/O runs in the default thread pool, never on the event loop.
+    """
+
+    def __init__(self, count, use_caption=False, snapshot=None):
+        self.count = min(count, MAX_WORKERS)
+        self.use_caption = use_caption
+        # INDEX_SNAPSHOT path, every worker maps the same file so its pages are shared between them
+        self.snapshot_path = snapshot
+        self.workers = []
+
+    @property
+    def ready(self):
+        return any(worker.ready for worker in self.workers)
+
+    def start(self):
+        # imported here, only bots running search workers need it
+        import multiprocessing
+
+        # spawn, a forked copy of a running event loop and MongoDB client is not safe to use
+        context = multiprocessing.get_context("spawn")
+        for i in range(self.count):
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(child, self.use_caption, self.snapshot_path),
+                                      name=f"search-worker-{i}", daemon=True)
+            process.start()
+            # the worker's end stays open only in the worker, so recv sees EOFError once it exits
+            child.close()
+            worker = _Worker(process, parent)
+            self.workers.append(worker)
+            asyncio.ensure_future(self._wait_ready(worker))
+
+    async def _wait_ready(self, worker):
+        loop = asyncio.get_event_loop()
+        try:
+            size = await loop.run_in_executor(None, worker.conn.recv)
+        except EOFError:
+            logger.error(f"{worker.process.name} exited while building its index")
+            return
+        while worker.pending:
+            batch, worker.pending = worker.pending, []
+            for message in batch:
+                await loop.run_in_executor(None, worker.send, message)
+        worker.ready = True
+        logger.info(f"{worker.process.name} is ready with {size} files")
+
+    async def _broadcast(self, message):
+        loop = asyncio.get_event_loop()
+        for worker in self.workers:
+            if worker.ready:
+                try:
+                    await loop.run_in_executor(None, worker.send, message)
+                except OSError:
+                    worker.ready = False
+                    logger.error(f"{worker.process.name} stopped, exit code {worker.process.exitcode}")
+            elif worker.process.is_alive():
+                worker.pending.append(message)
+
+    async def add(self, docs):
+        await self._broadcast(("add", [{key: doc.get(key) for key in INDEX_PROJECTION} for doc in docs]))
+
+    async def remove(self, file_ids):
+        await self._broadcast(("remove", [str(file_id) for file_id in file_ids]))
+
+    @staticmethod
+    def _tag(key, i):
+        if isinstance(key, tuple):
+            return key[0], key[1] * MAX_WORKERS + i
+        return key * MAX_WORKERS + i
+
+    @staticmethod
+    def _untag(key):
+        """(worker index, key for that worker) of a key returned by page"""
+        if isinstance(key, tuple):
+            return key[1] % MAX_WORKERS, (key[0], key[1] // MAX_WORKERS)
+        return key % MAX_WORKERS, key // MAX_WORKERS
+
+    async def page(self, query, file_type, limit, after, *args):
+        """
+        index_page on the least busy ready worker, or for a next page on the worker that answered the previous one,
+        as workers number files differently. None if that worker or no worker could answer.
+        """
+        if after is None:
+            ready = [i for i, w in enumerate(self.workers) if w.ready]
+            if not ready:
+                return None
+            i = min(ready, key=lambda i: self.workers[i].inflight)
+        else:
+            i, after = self._untag(after)
+            if i >= len(self.workers) or not self.workers[i].ready:
+                return None
+        worker = self.workers[i]
+        worker.inflight += 1
+        try:
+            docs, next_key, scanned, complete = await asyncio.get_event_loop().run_in_executor(
+                None, worker.request, ("page", (query, file_type, limit, after, *args)),
+            )
+        except (EOFError, OSError):
+            worker.ready = False
+            logger.error(f"{worker.process.name} stopped answering, exit code {worker.process.exitcode}")
+            return None
+        finally:
+            worker.inflight -= 1
+        return docs, None if next_key is None else self._tag(next_key, i), scanned, complete
+
+    async def snapshot(self, path, words, taken):
+        """Have one ready worker write its index to `path`, returns the number of files or None"""
+        ready = [w for w in self.workers if w.ready]
+        if not ready:
+            return None
+        worker = min(ready, key=lambda w: w.inflight)
+        worker.inflight += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, worker.request, ("snapshot", (path, words, taken)),
+            )
+        except (EOFError, OSError):
+            worker.ready = False
+            logger.error(f"{worker.process.name} stopped answering, exit code {worker.process.exitcode}")
+            return None
+        finally:
+            worker.inflight -= 1
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                worker.send(("stop", None))
+            except OSError:
+                pass
+            worker.process.join(timeout=5)